@@ -0,0 +1,168 @@
+"""Перевірка кластерного режиму на одній машині.
+
+Запуск: python benchmarks/bench_cluster.py [--workers 3 --channels 60 --forwards 3000]
+
+Запускає кілька процесів-воркерів (як run_cluster у bot.py) над спільною БД
+у режимі WAL, кожен із FakeSession замість Bot API. Посеред доставки лідера
+вбивається SIGKILL і перезапускається з тим самим номером шарда. Наприкінці
+перевіряється, що завдання лідера ніколи не виконувалися двома процесами
+одночасно, кожен канал обслуговував лише свій шард, а outbox спорожнів.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("SUPERADMIN_ID", "1")
+os.environ.setdefault("DB_FILE", os.path.join(tempfile.mkdtemp(prefix="bench_cluster_"), "bot_data.db"))
+os.environ.setdefault("LEASE_TTL", "2")
+os.environ.setdefault("OUTBOX_POLL_INTERVAL", "0.1")
+os.environ.setdefault("GLOBAL_SEND_RATE", "1000000")
+os.environ.setdefault("CHAT_SEND_RATE", "1000000")
+os.environ.setdefault("CHAT_SEND_BURST", "1000000")
+
+import bot  # noqa: E402
+from fake_api import FakeSession  # noqa: E402
+
+MAIN_CHANNEL = -100500
+TICK_INTERVAL = 0.05
+
+
+def _prepare(conn, channels, forwards):
+    conn.execute("CREATE TABLE IF NOT EXISTS bench_ticks (ts REAL, shard INTEGER, pid INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS bench_forwards (shard INTEGER, chat_id INTEGER)")
+    conn.executemany("INSERT INTO channels (channel_id, expiry_date) VALUES (?, '2999-01-01T00:00:00')",
+                     [(chat_id,) for chat_id in channels])
+    now = time.time()
+    conn.executemany("INSERT INTO outbox (chat_id, from_chat_id, message_ids, next_attempt_at, created_at) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     [(channels[i % len(channels)], MAIN_CHANNEL, str(i + 1), now, now) for i in range(forwards)])
+
+
+async def setup(args):
+    await bot.init_db()
+    channels = [-1001000000000 - i for i in range(args.channels)]
+    await bot.db.run(_prepare, channels, args.forwards)
+    await bot.db.close()
+
+
+@bot.leader_only
+async def tick():
+    await bot.execute_db("INSERT INTO bench_ticks (ts, shard, pid) VALUES (?, ?, ?)",
+                         (time.time(), bot.SHARD_INDEX, os.getpid()))
+
+
+async def worker(latency):
+    fake = FakeSession(latency=latency)
+    bot.bot.session = fake
+    await bot.init_db()
+    await bot.reload_config()
+    await bot.outbox.recover()
+    bot.outbox.start()
+    bot.leadership.start()
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    reported = 0
+    while not stop.is_set():
+        await tick()
+        forwards, reported = fake.forwards[reported:], len(fake.forwards)
+        if forwards:
+            await bot.db.executemany("INSERT INTO bench_forwards (shard, chat_id) VALUES (?, ?)",
+                                     [(bot.SHARD_INDEX, chat_id) for _, chat_id, _ in forwards])
+        try:
+            await asyncio.wait_for(stop.wait(), TICK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+    await bot.leadership.stop()
+    await bot.outbox.stop()
+    forwards = fake.forwards[reported:]
+    await bot.db.executemany("INSERT INTO bench_forwards (shard, chat_id) VALUES (?, ?)",
+                             [(bot.SHARD_INDEX, chat_id) for _, chat_id, _ in forwards])
+    await bot.db.close()
+
+
+def spawn(args, index):
+    env = dict(os.environ, SHARD_COUNT=str(args.workers), SHARD_INDEX=str(index))
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker",
+                             "--latency", str(args.latency)], env=env)
+
+
+def query(conn, sql):
+    return conn.execute(sql).fetchall()
+
+
+def leader_switches(ticks):
+    """Кількість змін лідера та найдовша пауза між тиками (час перемикання)."""
+    switches, gap = 0, 0.0
+    for (ts_prev, pid_prev), (ts, pid) in zip(ticks, ticks[1:]):
+        gap = max(gap, ts - ts_prev)
+        if pid != pid_prev:
+            switches += 1
+    return switches, gap
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--channels", type=int, default=60)
+    parser.add_argument("--forwards", type=int, default=3000)
+    parser.add_argument("--latency", type=float, default=0.02, help="імітована затримка Bot API, с")
+    parser.add_argument("--kill-after", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        asyncio.run(worker(args.latency))
+        return 0
+
+    asyncio.run(setup(args))
+    conn = sqlite3.connect(os.environ["DB_FILE"], timeout=30)
+    started = time.monotonic()
+    processes = {index: spawn(args, index) for index in range(args.workers)}
+
+    while not query(conn, "SELECT 1 FROM bench_ticks LIMIT 1"):
+        time.sleep(0.05)
+    time.sleep(args.kill_after)
+    leader_shard = query(conn, "SELECT shard FROM bench_ticks ORDER BY ts DESC LIMIT 1")[0][0]
+    processes[leader_shard].send_signal(signal.SIGKILL)
+    processes[leader_shard].wait()
+    killed_at = time.monotonic() - started
+    processes[leader_shard] = spawn(args, leader_shard)
+
+    deadline = time.monotonic() + args.timeout
+    while query(conn, "SELECT COUNT(*) FROM outbox")[0][0] and time.monotonic() < deadline:
+        time.sleep(0.1)
+    elapsed = time.monotonic() - started
+    time.sleep(0.5)
+    for process in processes.values():
+        process.send_signal(signal.SIGTERM)
+    for process in processes.values():
+        process.wait()
+
+    left = query(conn, "SELECT COUNT(*) FROM outbox")[0][0]
+    forwards = query(conn, "SELECT shard, chat_id FROM bench_forwards")
+    misrouted = sum(1 for shard, chat_id in forwards if abs(chat_id) % args.workers != shard)
+    switches, gap = leader_switches(query(conn, "SELECT ts, pid FROM bench_ticks ORDER BY ts"))
+    conn.close()
+
+    print(f"workers          {args.workers}, killed shard {leader_shard} at {killed_at:.2f}s")
+    print(f"outbox           {args.forwards - left}/{args.forwards} delivered in {elapsed:.2f}s, {left} left")
+    print(f"recorded         {len(forwards)} forwards, {misrouted} outside their shard")
+    print(f"leader switches  {switches}, longest gap between leader ticks {gap:.2f}s")
+    ok = left == 0 and misrouted == 0 and switches == 1
+    print("cluster          " + ("OK" if ok else "FAILED"))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""Порівняння старого execute_db (з'єднання на кожен запит) з bot.Database.
+
+Запуск: python benchmarks/bench_db.py [--ops 2000]
+
+Для кожного режиму вимірюється пропускна здатність типових запитів бота
+та максимальна затримка циклу подій, поки запити виконуються.
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("SUPERADMIN_ID", "1")
+
+import bot  # noqa: E402
+
+UPSERT = ("INSERT INTO analytics (date, action, count) VALUES (?, ?, 1) "
+          "ON CONFLICT(date, action) DO UPDATE SET count = count + 1")
+SELECT = "SELECT * FROM channels"
+
+
+def legacy_execute_db(path, query, params=()):
+    # Поведінка execute_db до переходу на bot.Database
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute(query, params)
+    conn.commit()
+    result = c.fetchall()
+    conn.close()
+    return result
+
+
+async def measure_lag(stop, result):
+    """Фіксує найдовший проміжок, коли цикл подій не давав тікеру виконатися.
+
+    Проміжок рахується від попереднього тіку, тож режим, який взагалі не
+    віддає керування, дає затримку на весь час навантаження, а не нуль.
+    """
+    interval = 0.001
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        result[0] = max(result[0], now - last - interval)
+        last = now
+
+
+async def run_mode(name, execute, ops):
+    lag = [0.0]
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(measure_lag(stop, lag))
+    await asyncio.sleep(0)  # даємо тікеру стартувати до навантаження
+    rows = []
+    for query, params in ((UPSERT, ("2024-01-01", "forward_message")), (SELECT, ())):
+        started = time.perf_counter()
+        for _ in range(ops):
+            await execute(query, params)
+        elapsed = time.perf_counter() - started
+        rows.append((query.split()[0], ops / elapsed))
+    stop.set()
+    await ticker
+    for kind, rate in rows:
+        print(f"{name:<8} {kind:<7} {rate:>10.0f} ops/s")
+    print(f"{name:<8} max event-loop lag {lag[0] * 1000:.2f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        conn = sqlite3.connect(legacy_path)
+        bot._migrate(conn)
+        conn.executemany("INSERT INTO channels (channel_id, expiry_date) VALUES (?, ?)",
+                         [(-100 - i, "2999-01-01T00:00:00") for i in range(200)])
+        conn.commit()
+        conn.close()
+
+        async def legacy(query, params):
+            return legacy_execute_db(legacy_path, query, params)
+
+        database = bot.Database(os.path.join(tmp, "pooled.db"))
+        await database.run(bot._migrate)
+        await database.executemany("INSERT INTO channels (channel_id, expiry_date) VALUES (?, ?)",
+                                   [(-100 - i, "2999-01-01T00:00:00") for i in range(200)])
+
+        await run_mode("legacy", legacy, args.ops)
+        await run_mode("database", database.execute, args.ops)
+        await database.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+"""Перевірка пропускної здатності та дотримання лімітів bot.FanOut на фейковому боті.
+
+Запуск: python benchmarks/bench_fanout.py [--posts 20 --channels 50]
+
+Фейковий бот відповідає із затримкою, іноді повертає TelegramRetryAfter і
+записує час кожного успішного надсилання. Наприкінці перевіряється, що
+ні глобальний, ні поканальний ліміт не перевищено.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("SUPERADMIN_ID", "1")
+
+from aiogram.exceptions import TelegramRetryAfter  # noqa: E402
+from aiogram.methods import ForwardMessage  # noqa: E402
+
+import bot  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self, latency, retry_ratio, seed):
+        self.latency = latency
+        self.retry_ratio = retry_ratio
+        self.random = random.Random(seed)
+        self.sent = defaultdict(list)
+        self.retry_after = 0
+
+    async def forward(self, chat_id, message_id):
+        # Ліміт стосується моменту запиту, а не відповіді з випадковою затримкою
+        requested = time.monotonic()
+        await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.retry_ratio:
+            self.retry_after += 1
+            method = ForwardMessage(chat_id=chat_id, from_chat_id=-1, message_id=message_id)
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+        self.sent[chat_id].append(requested)
+
+
+def max_in_window(timestamps, window):
+    timestamps = sorted(timestamps)
+    best = start = 0
+    for end, ts in enumerate(timestamps):
+        while ts - timestamps[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--global-rate", type=float, default=200)
+    parser.add_argument("--global-burst", type=int, default=bot.GLOBAL_SEND_BURST)
+    parser.add_argument("--chat-rate", type=float, default=5)
+    parser.add_argument("--chat-burst", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--retry-ratio", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    fake = FakeBot(args.latency, args.retry_ratio, args.seed)
+    fanout = bot.FanOut(global_rate=args.global_rate, chat_rate=args.chat_rate,
+                        chat_burst=args.chat_burst, concurrency=64, max_retries=100,
+                        global_burst=args.global_burst)
+    peak = {'queued': 0, 'in_flight': 0}
+
+    async def sample():
+        while True:
+            stats = fanout.stats()
+            peak['queued'] = max(peak['queued'], stats['queued'])
+            peak['in_flight'] = max(peak['in_flight'], stats['in_flight'])
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.create_task(sample())
+    started = time.monotonic()
+    jobs = [fanout.send(chat_id, lambda chat_id=chat_id, post=post: fake.forward(chat_id, post))
+            for post in range(args.posts) for chat_id in range(args.channels)]
+    await asyncio.gather(*jobs)
+    elapsed = time.monotonic() - started
+    sampler.cancel()
+
+    total = sum(len(ts) for ts in fake.sent.values())
+    all_ts = [ts for chat_ts in fake.sent.values() for ts in chat_ts]
+    global_peak = max_in_window(all_ts, 1.0)
+    chat_peak = max(max_in_window(ts, 1.0) for ts in fake.sent.values())
+    global_limit = args.global_rate + args.global_burst
+    chat_limit = args.chat_rate + args.chat_burst
+
+    print(f"forwards         {total} in {elapsed:.2f}s ({total / elapsed:.0f}/s)")
+    print(f"retry_after      {fake.retry_after}")
+    print(f"peak queued      {peak['queued']}, peak in flight {peak['in_flight']}")
+    print(f"global peak/1s   {global_peak} (limit {global_limit:.0f})")
+    print(f"chat peak/1s     {chat_peak} (limit {chat_limit:.0f})")
+    ok = global_peak <= global_limit and chat_peak <= chat_limit
+    print("limits           " + ("OK" if ok else "EXCEEDED"))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,138 @@
+"""Затримка від отримання оновлення до пересилання: long polling проти вебхука.
+
+Запуск: python benchmarks/bench_ingest.py [--updates 500 --channels 10]
+
+Обидва режими використовують справжній Dispatcher із bot.py і FakeSession
+замість мережі. У режимі polling оновлення віддаються через getUpdates, у
+режимі webhook вони надсилаються POST-запитами на локальний сервер.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.mkdtemp(prefix="bench_ingest_")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("SUPERADMIN_ID", "1")
+os.environ["DB_FILE"] = os.path.join(TMP, "bot_data.db")
+# Ліміти Telegram тут не перевіряються, тож не даємо їм впливати на затримку
+os.environ["GLOBAL_SEND_RATE"] = "1000000"
+os.environ["CHAT_SEND_RATE"] = "1000000"
+os.environ["CHAT_SEND_BURST"] = "1000000"
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import bot  # noqa: E402
+from fake_api import FakeSession, channel_post_update  # noqa: E402
+
+MAIN_CHANNEL = -100500
+SECRET = "bench-secret"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def prepare(channels):
+    await bot.init_db()
+    await bot.reload_config()
+    await bot.add_main_channel(MAIN_CHANNEL)
+    for i in range(channels):
+        await bot.add_channel(-1000 - i, 30)
+        await bot.add_filter(-1000 - i, 'word', 'bench')
+
+
+async def wait_for(fake, expected, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while len(fake.forwards) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.005)
+
+
+def report(name, sent, fake):
+    latencies = sorted((ts - sent[message_id]) * 1000 for ts, _, message_id in fake.forwards)
+    if not latencies:
+        print(f"{name:<8} no forwards")
+        return
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:<8} forwards={len(latencies)} p50={statistics.median(latencies):.2f}ms "
+          f"p99={p99:.2f}ms max={latencies[-1]:.2f}ms")
+
+
+async def run_polling(args, base):
+    fake = FakeSession(latency=args.latency)
+    bot.bot.session = fake
+    polling = asyncio.create_task(bot.dp.start_polling(bot.bot, handle_signals=False, close_bot_session=False))
+    await asyncio.sleep(0.2)
+    sent = {}
+    for i in range(args.updates):
+        update_id = base + i
+        sent[update_id] = time.perf_counter()
+        fake.push_update(channel_post_update(update_id, MAIN_CHANNEL, f"bench post {i}"), bot.bot)
+        await asyncio.sleep(args.interval)
+    await wait_for(fake, args.updates * args.channels)
+    await bot.dp.stop_polling()
+    await polling
+    report("polling", sent, fake)
+
+
+async def run_webhook(args, base):
+    fake = FakeSession(latency=args.latency)
+    bot.bot.session = fake
+    ingest = bot.WebhookIngest(bot.dp, bot.bot, secret=SECRET, workers=args.workers)
+    app = web.Application()
+    ingest.setup(app, "/webhook")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = free_port()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    ingest.start()
+    url = f"http://127.0.0.1:{port}/webhook"
+    sent = {}
+    async with aiohttp.ClientSession(headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as http:
+        for i in range(args.updates):
+            update_id = base + i
+            sent[update_id] = time.perf_counter()
+            async with http.post(url, json=channel_post_update(update_id, MAIN_CHANNEL, f"bench post {i}")) as response:
+                response.raise_for_status()
+            await asyncio.sleep(args.interval)
+    await wait_for(fake, args.updates * args.channels)
+    await site.stop()
+    await ingest.stop()
+    await runner.cleanup()
+    report("webhook", sent, fake)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=0.002)
+    parser.add_argument("--latency", type=float, default=0.0, help="імітована затримка Bot API, с")
+    parser.add_argument("--workers", type=int, default=bot.WEBHOOK_WORKERS)
+    parser.add_argument("--mode", choices=["both", "polling", "webhook"], default="both")
+    args = parser.parse_args()
+
+    await prepare(args.channels)
+    await bot.outbox.recover()
+    bot.outbox.start()
+    if args.mode in ("both", "polling"):
+        await run_polling(args, base=1)
+    if args.mode in ("both", "webhook"):
+        await run_webhook(args, base=1_000_000)
+    await bot.outbox.stop()
+    await bot.db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,198 @@
+"""Навантажувальний бенчмарк конвеєра channel_post.
+
+Запуск: python benchmarks/bench_pipeline.py [--channels 300 --filters 3000 --posts 2000]
+
+Генерує канали, фільтри (теги, слова, фрази, комбінації через '&' українською
+та англійською) і пости, проганяє їх через справжній Dispatcher
+(dp.feed_update) із FakeSession замість Bot API і звітує пропускну
+здатність, p50/p99 затримки прийому, час доставки через outbox та
+кількість операцій з БД на пост.
+Генерація детермінована (--seed), а --output зберігає результат у JSON
+для порівняння між запусками.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.mkdtemp(prefix="bench_pipeline_")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("SUPERADMIN_ID", "1")
+os.environ["DB_FILE"] = os.path.join(TMP, "bot_data.db")
+os.environ.setdefault("GLOBAL_SEND_RATE", "1000000")
+os.environ.setdefault("CHAT_SEND_RATE", "1000000")
+os.environ.setdefault("CHAT_SEND_BURST", "1000000")
+
+from aiogram import types  # noqa: E402
+
+import bot  # noqa: E402
+from fake_api import FakeSession, channel_post_update  # noqa: E402
+
+MAIN_CHANNEL = -100500
+
+WORDS_UA = ["знижка", "продаж", "квартира", "оренда", "робота", "вакансія", "київ", "львів",
+            "автомобіль", "ремонт", "терміново", "новина", "ціна", "доставка", "подарунок",
+            "одеса", "харків", "навчання", "курс", "техніка"]
+WORDS_EN = ["sale", "discount", "apartment", "rent", "job", "vacancy", "kyiv", "lviv",
+            "car", "repair", "urgent", "news", "price", "delivery", "gift",
+            "odesa", "kharkiv", "course", "laptop", "phone"]
+FILLER = ["і", "та", "для", "на", "у", "з", "the", "a", "for", "in", "with", "new", "best",
+          "сьогодні", "завтра", "today", "now", "free", "безкоштовно", "тут"]
+VOCAB = WORDS_UA + WORDS_EN
+
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def generate_filters(rng, channels, count):
+    rows = []
+    for filter_id in range(1, count + 1):
+        channel_id = rng.choice(channels)
+        kind = rng.choices(["tag", "word", "phrase", "combination"], weights=[3, 4, 2, 1])[0]
+        if kind == "tag":
+            value = "#" + rng.choice(VOCAB) + rng.choice(["", "", str(rng.randint(1, 99))])
+        elif kind == "word":
+            value = rng.choice(VOCAB)
+        elif kind == "phrase":
+            value = " ".join(rng.sample(VOCAB, 2))
+        else:
+            value = " & ".join(rng.sample(VOCAB, rng.randint(2, 3)))
+        rows.append((filter_id, channel_id, kind, value))
+    return rows
+
+
+def generate_post(rng, update_id):
+    words = [rng.choice(VOCAB if rng.random() < 0.4 else FILLER) for _ in range(rng.randint(8, 60))]
+    text = ""
+    entities = []
+    for word in words:
+        if text:
+            text += " "
+        if rng.random() < 0.05:
+            tag = "#" + rng.choice(VOCAB)
+            entities.append({"type": "hashtag", "offset": utf16_len(text), "length": utf16_len(tag)})
+            text += tag
+        else:
+            text += word.capitalize() if rng.random() < 0.1 else word
+    extra = {"entities": entities} if entities else {}
+    return channel_post_update(update_id, MAIN_CHANNEL, text, **extra)
+
+
+def _seed(conn, channels, filters):
+    conn.execute("INSERT OR REPLACE INTO main_channels (channel_id) VALUES (?)", (MAIN_CHANNEL,))
+    conn.executemany("INSERT INTO channels (channel_id, expiry_date) VALUES (?, '2999-01-01T00:00:00')",
+                     [(channel_id,) for channel_id in channels])
+    conn.executemany("INSERT INTO filters (id, channel_id, filter_type, filter_value) VALUES (?, ?, ?, ?)",
+                     filters)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=300)
+    parser.add_argument("--filters", type=int, default=3000)
+    parser.add_argument("--posts", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="імітована затримка Bot API, с")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="файл JSON для збереження результату")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    channels = [-1001000000000 - i for i in range(args.channels)]
+    filters = generate_filters(rng, channels, args.filters)
+    posts = [generate_post(rng, update_id) for update_id in range(1, args.posts + 1)]
+
+    await bot.init_db()
+    await bot.db.run(_seed, channels, filters)
+    await bot.reload_config()
+    plan_problems = await bot.db.run(bot.check_query_plans)
+
+    fake = FakeSession(latency=args.latency)
+    bot.bot.session = fake
+    await bot.outbox.recover()
+    bot.outbox.start()
+    updates = [types.Update.model_validate(post, context={"bot": bot.bot}) for post in posts]
+
+    # Прогрів, щоб не враховувати ледачу ініціалізацію
+    await bot.dp.feed_update(bot.bot, updates[0])
+    while bot.outbox.pending:
+        await asyncio.sleep(0.01)
+    fake.forwards.clear()
+    fake.calls.clear()
+
+    latencies = []
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async def feeder():
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.perf_counter()
+            await bot.dp.feed_update(bot.bot, update)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    db_ops_before = bot.db.operations
+    started = time.perf_counter()
+    await asyncio.gather(*(feeder() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    db_ops = bot.db.operations - db_ops_before
+    while bot.outbox.pending:
+        await asyncio.sleep(0.01)
+    delivered = time.perf_counter() - started
+    await bot.outbox.stop()
+    await bot.flush_analytics()
+    await bot.db.close()
+
+    latencies.sort()
+    result = {
+        "params": vars(args),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "posts_per_second": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(statistics.median(latencies), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "max": round(latencies[-1], 3),
+        },
+        "delivery_seconds": round(delivered, 3),
+        "forwards": len(fake.forwards),
+        "forwards_per_post": round(len(fake.forwards) / len(latencies), 2),
+        "db_ops_per_post": round(db_ops / len(latencies), 3),
+        "api_calls": dict(fake.calls),
+        "full_scans": [f"{query}: {detail}" for query, detail in plan_problems],
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if plan_problems:
+        print(f"FAILED: {len(plan_problems)} hot queries use a full table scan", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,78 @@
+"""Локальна імітація Bot API для бенчмарків.
+
+FakeSession підміняє мережеву сесію aiogram: запити не виходять за межі
+процесу, getUpdates віддає згенеровані оновлення, а кожен виклик методу
+фіксується з міткою часу.
+"""
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime
+
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import ForwardMessage, ForwardMessages, GetMe, GetUpdates, SendMessage
+
+
+def channel_post_update(update_id, chat_id, text, message_id=None, **extra):
+    """Повертає сирий JSON оновлення channel_post, як його надсилає Telegram."""
+    post = {
+        "message_id": message_id or update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "channel", "title": "main"},
+        "text": text,
+    }
+    post.update(extra)
+    return {"update_id": update_id, "channel_post": post}
+
+
+class FakeSession(BaseSession):
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self.forwards = []
+        self._updates = asyncio.Queue()
+
+    def push_update(self, data, bot):
+        self._updates.put_nowait(types.Update.model_validate(data, context={"bot": bot}))
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, GetUpdates):
+            return await self._get_updates(method)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, GetMe):
+            return types.User(id=42, is_bot=True, first_name="bench", username="bench_bot")
+        if isinstance(method, ForwardMessage):
+            self.forwards.append((time.perf_counter(), method.chat_id, method.message_id))
+            return self._message(method.chat_id, method.message_id)
+        if isinstance(method, ForwardMessages):
+            now = time.perf_counter()
+            self.forwards.extend((now, method.chat_id, message_id) for message_id in method.message_ids)
+            return [types.MessageId(message_id=message_id) for message_id in method.message_ids]
+        if isinstance(method, SendMessage):
+            return self._message(method.chat_id, 1)
+        return True
+
+    async def _get_updates(self, method):
+        try:
+            first = await asyncio.wait_for(self._updates.get(), timeout=min(method.timeout or 1, 1))
+        except asyncio.TimeoutError:
+            return []
+        updates = [first]
+        while not self._updates.empty() and len(updates) < (method.limit or 100):
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    @staticmethod
+    def _message(chat_id, message_id):
+        return types.Message(message_id=message_id, date=datetime.now(),
+                             chat=types.Chat(id=chat_id, type="channel"))
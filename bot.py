@@ -1,29 +1,79 @@
+import argparse
 import asyncio
+import atexit
+import bisect
+import csv
+import glob
+import gzip
+import heapq
+import hmac
+import itertools
+import json
+import queue
+import random
 import logging
+import logging.handlers
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from functools import wraps
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from types import MappingProxyType
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiohttp import web
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Filter
 from aiogram.types import FSInputFile, ReplyKeyboardMarkup, KeyboardButton
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import os
 import sqlite3
-import matplotlib.pyplot as plt
+import time
 import io
 import shutil
 import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 from dotenv import load_dotenv
 
 # Завантаження змінних середовища
 load_dotenv()
 
-log_filename = 'bot.log'
+log_filename = os.getenv("LOG_FILE", 'bot.log')
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 10))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")  # напр. "midnight" — ротація за часом замість розміру
+
+def _gzip_rotator(source, dest):
+    # Заповнений файл логу стискається одразу під час ротації
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
 # Налаштування логування
+# Записи лише кладуться в чергу; файловий I/O, ротацію і стиснення виконує
+# окремий потік QueueListener, тож цикл подій не чекає на диск
 logger = logging.getLogger("bot")
-hdlr = logging.FileHandler(log_filename, mode='a', encoding='utf-8')
-hdlr.setFormatter(logging.Formatter("%(asctime)s %(funcName)s %(levelname)s %(message)s"))
+if LOG_ROTATE_WHEN:
+    file_handler = logging.handlers.TimedRotatingFileHandler(log_filename, when=LOG_ROTATE_WHEN,
+                                                             backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+else:
+    file_handler = logging.handlers.RotatingFileHandler(log_filename, maxBytes=LOG_MAX_BYTES,
+                                                        backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+file_handler.namer = lambda name: name + ".gz"
+file_handler.rotator = _gzip_rotator
+file_handler.setFormatter(logging.Formatter("%(asctime)s %(funcName)s %(levelname)s %(message)s"))
+log_queue = queue.SimpleQueue()
+hdlr = logging.handlers.QueueHandler(log_queue)
 logger.addHandler(hdlr)
 logger.setLevel(logging.INFO)
+log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+log_listener.start()
+# Дописуємо в файл усе, що лишилося в черзі, перед виходом процесу
+atexit.register(log_listener.stop)
 
 # Ініціалізація бота та диспетчера
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -34,15 +84,250 @@ dp = Dispatcher()
 scheduler = AsyncIOScheduler()
 
 # Шляхи до файлів даних
-DB_FILE = 'bot_data.db'
+DB_FILE = os.getenv("DB_FILE", 'bot_data.db')
 
 # ID суперадміністратора
 SUPERADMIN_ID = int(os.getenv("SUPERADMIN_ID"))
 
+# Кластерний режим: кількість процесів бота і номер поточного (див. run_cluster)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", 0))
+if not 0 <= SHARD_INDEX < SHARD_COUNT:
+    raise ValueError(f"SHARD_INDEX must be in [0, {SHARD_COUNT}), got {SHARD_INDEX}")
+
+
+# Метрики
+# Збираються завжди: кожне спостереження — це пошук у словнику та bisect
+# Метрики без автентифікації, тож за замовчуванням доступні лише локально
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # 0 — сервер метрик вимкнено
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+LOOP_LAG_INTERVAL = 0.5
+
+class Histogram:
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Верхня межа кошика, в який потрапляє q-квантиль."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """Мінімальний реєстр лічильників, гістограм і датчиків у форматі Prometheus."""
+
+    HELP = {
+        'handler_seconds': "Handler latency by handler name",
+        'db_seconds': "Time spent in database calls by query type",
+        'filter_match_seconds': "Time spent matching a post against filters",
+        'forwards_total': "Forward attempts by target channel and result",
+        'retry_after_total': "TelegramRetryAfter responses by target chat",
+        'event_loop_lag_seconds': "Delay of a periodic event-loop tick",
+    }
+
+    def __init__(self):
+        self.started = time.time()
+        self.last_loop_lag = 0.0
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, func):
+        """Реєструє датчик, значення якого обчислюється під час експорту."""
+        self.gauges[name] = func
+
+    def histograms_of(self, name):
+        """Повертає {мітки: Histogram} для гістограми name."""
+        return {labels: histogram for (key, labels), histogram in self.histograms.items() if key == name}
+
+    def total(self, name, **labels):
+        """Сума лічильника name по всіх серіях, що містять задані мітки."""
+        wanted = set(labels.items())
+        return sum(value for (key, series), value in self.counters.items()
+                   if key == name and wanted <= set(series))
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.HELP:
+                    lines.append(f"# HELP bot_{name} {self.HELP[name]}")
+                lines.append(f"# TYPE bot_{name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            describe(name, "counter")
+            lines.append(f"bot_{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(Histogram.BUCKETS + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"bot_{name}_bucket{self._labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"bot_{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"bot_{name}_count{self._labels(labels)} {histogram.count}")
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.error(f"Failed to read gauge {name}: {e}")
+                continue
+            describe(name, "gauge")
+            lines.append(f"bot_{name} {value}")
+        lines.append(f"bot_uptime_seconds {time.time() - self.started}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Вимірює час виконання хендлерів повідомлень і постів."""
+
+    async def __call__(self, handler, event, data):
+        # Для команд і кнопок хендлер один (route_message), тож беремо ім'я з маршруту
+        route = data.get("route")
+        callback = route.callback if route is not None else getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe('handler_seconds', time.perf_counter() - started, handler=name)
+
+dp.message.middleware(HandlerTimingMiddleware())
+dp.channel_post.middleware(HandlerTimingMiddleware())
+
+async def monitor_event_loop_lag(interval=LOOP_LAG_INTERVAL):
+    """Періодично вимірює, наскільки пізніше за план прокидається цикл подій."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        metrics.observe('event_loop_lag_seconds', lag)
+        metrics.last_loop_lag = lag
+
+async def metrics_handler(request):
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server():
+    """Запускає окремий HTTP-сервер метрик, якщо задано METRICS_PORT."""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # Кожен процес кластера слухає власний порт: METRICS_PORT + SHARD_INDEX
+    port = METRICS_PORT + SHARD_INDEX
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"Metrics available on {METRICS_HOST}:{port}{METRICS_PATH}")
+    return runner
+
+# Асинхронний доступ до бази даних
+class Database:
+    """Довготривале з'єднання SQLite у виділеному потоці.
+
+    Усі запити виконуються в одному потоці БД, тож цикл подій не блокується
+    файловим I/O, а підготовлені запити кешуються самим з'єднанням.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.operations = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _call(self, func, *args):
+        if self._conn is None:
+            self._conn = self._connect()
+        with self._conn:
+            return func(self._conn, *args)
+
+    async def run(self, func, *args, label=None):
+        """Виконує func(conn, *args) у потоці БД в межах однієї транзакції."""
+        loop = asyncio.get_running_loop()
+        self.operations += 1
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, self._call, func, *args)
+        finally:
+            metrics.observe('db_seconds', time.perf_counter() - started, query=label or func.__name__)
+
+    async def execute(self, query, params=()):
+        return await self.run(lambda conn: conn.execute(query, params).fetchall(), label=_query_label(query))
+
+    async def executemany(self, query, seq_of_params):
+        return await self.run(lambda conn: conn.executemany(query, seq_of_params).rowcount,
+                              label=_query_label(query))
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=True)
+
+def _query_label(query):
+    # Тип запиту і таблиця, напр. "SELECT analytics" — без параметрів, щоб мітки не розросталися
+    match = re.match(r"\s*(\w+).*?\b(?:FROM|INTO|UPDATE)\s+(\w+)", query, re.IGNORECASE | re.DOTALL)
+    if match:
+        return f"{match.group(1).upper()} {match.group(2)}"
+    return query.split(None, 1)[0].upper() if query.strip() else "EMPTY"
+
+db = Database(DB_FILE)
 
 # Ініціалізація бази даних
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
+# Кожна міграція виконується один раз в окремій транзакції; номер застосованої
+# міграції зберігається в PRAGMA user_version
+def _migration_1(conn):
+    # Початкова схема (для старих баз таблиці вже існують)
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS channels
                  (id INTEGER PRIMARY KEY, channel_id INTEGER, expiry_date TEXT)''')
@@ -56,111 +341,937 @@ def init_db():
                  (id INTEGER PRIMARY KEY, max_messages INTEGER, time_window INTEGER)''')
     c.execute('''CREATE TABLE IF NOT EXISTS analytics
                  (date TEXT, action TEXT, count INTEGER, UNIQUE(date,action))''')
-    conn.commit()
-    conn.close()
 
-init_db()
+def _migration_2(conn):
+    # Прибираємо дублікати каналів (залишаємо останній запис) і додаємо індекси
+    c = conn.cursor()
+    c.execute('''DELETE FROM channels WHERE id NOT IN (SELECT MAX(id) FROM channels GROUP BY channel_id)''')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_channels_channel_id ON channels (channel_id)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_channels_expiry_date ON channels (expiry_date)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_filters_channel_id ON filters (channel_id)''')
 
-# Функції для роботи з базою даних
-def execute_db(query, params=()):
-    conn = sqlite3.connect(DB_FILE)
+def _migration_3(conn):
+    # Черга вихідних пересилань (outbox)
     c = conn.cursor()
-    c.execute(query, params)
-    conn.commit()
-    result = c.fetchall()
-    conn.close()
-    return result
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox
+                 (id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, from_chat_id INTEGER NOT NULL,
+                  message_ids TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL,
+                  last_error TEXT, created_at REAL NOT NULL)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)''')
+
+def _migration_4(conn):
+    # Координація процесів кластера: оренди лідерства та версія конфігурації
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS leases
+                 (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS meta
+                 (key TEXT PRIMARY KEY, value INTEGER NOT NULL)''')
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('config_version', 0)")
+
+def _migration_5(conn):
+    # Часові ряди аналітики: кошики по хвилині/годині/дню для каналів і фільтрів
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS analytics_series
+                 (resolution INTEGER NOT NULL, bucket INTEGER NOT NULL, kind TEXT NOT NULL,
+                  key INTEGER NOT NULL, count INTEGER NOT NULL,
+                  PRIMARY KEY (resolution, bucket, kind, key)) WITHOUT ROWID''')
+
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def _migrate(conn):
+    """Застосовує всі ще не виконані міграції та повертає версію схеми."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than supported {SCHEMA_VERSION}")
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= number:
+            # Цю міграцію вже застосував інший процес кластера
+            conn.rollback()
+            continue
+        MIGRATIONS[number - 1](conn)
+        conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+        logger.info(f"Database migrated to schema version {number}")
+    return SCHEMA_VERSION
+
+# Запити гарячого шляху. Кожен визначено один раз і використовується і в коді,
+# і в INDEXED_QUERIES, тож перевірка планів бачить саме той SQL, що виконується
+CHANNEL_EXISTS_QUERY = "SELECT 1 FROM channels WHERE channel_id = ?"
+DELETE_CHANNEL_QUERY = "DELETE FROM channels WHERE channel_id = ?"
+DELETE_CHANNEL_FILTERS_QUERY = "DELETE FROM filters WHERE channel_id = ?"
+DELETE_FILTER_QUERY = "DELETE FROM filters WHERE id = ?"
+OVERDUE_CHANNELS_QUERY = "SELECT channel_id FROM channels WHERE expiry_date <= ?"
+CONFIG_VERSION_QUERY = "SELECT value FROM meta WHERE key = 'config_version'"
+CLAIM_OUTBOX_QUERY = ("SELECT id, chat_id, from_chat_id, message_ids, attempts FROM outbox "
+                      "WHERE status = 'pending' AND next_attempt_at <= ? AND abs(chat_id) % ? = ? "
+                      "ORDER BY next_attempt_at LIMIT ?")
+MARK_SENDING_QUERY = "UPDATE outbox SET status = 'sending' WHERE id = ?"
+OUTBOX_DONE_QUERY = "DELETE FROM outbox WHERE id = ?"
+OUTBOX_RETRY_QUERY = "UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?"
+OUTBOX_DEAD_QUERY = "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?"
+COUNT_OUTBOX_QUERY = "SELECT COUNT(*) FROM outbox WHERE status = ?"
+DEAD_LETTERS_QUERY = ("SELECT id, chat_id, from_chat_id, message_ids, attempts, last_error FROM outbox "
+                      "WHERE status = 'dead' ORDER BY id DESC LIMIT ?")
+REQUEUE_DEAD_QUERY = ("UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, last_error = NULL "
+                      "WHERE status = 'dead'")
+REQUEUE_DEAD_ROW_QUERY = REQUEUE_DEAD_QUERY + " AND id = ?"
+PURGE_DEAD_QUERY = "DELETE FROM outbox WHERE status = 'dead' AND created_at < ?"
+ANALYTICS_SINCE_QUERY = "SELECT * FROM analytics WHERE date >= ?"
+SERIES_RANGE_QUERY = ("SELECT (bucket - ?) / ?, key, SUM(count) FROM analytics_series "
+                      "WHERE resolution IN (60, 3600, 86400) AND bucket >= ? AND bucket < ? AND kind = ? "
+                      "GROUP BY 1, 2")
+ROLLUP_SERIES_QUERY = ("INSERT INTO analytics_series (resolution, bucket, kind, key, count) "
+                       "SELECT ?, bucket - bucket % ?, kind, key, SUM(count) FROM analytics_series "
+                       "WHERE resolution = ? AND bucket < ? GROUP BY 2, 3, 4 "
+                       "ON CONFLICT(resolution, bucket, kind, key) DO UPDATE SET count = count + excluded.count")
+DELETE_SERIES_QUERY = "DELETE FROM analytics_series WHERE resolution = ? AND bucket < ?"
+
+# Запити, які не повинні сканувати таблиці повністю, з довільними параметрами
+INDEXED_QUERIES = [
+    (CHANNEL_EXISTS_QUERY, (0,)),
+    (DELETE_CHANNEL_QUERY, (0,)),
+    (DELETE_CHANNEL_FILTERS_QUERY, (0,)),
+    (DELETE_FILTER_QUERY, (0,)),
+    (OVERDUE_CHANNELS_QUERY, ('',)),
+    (CONFIG_VERSION_QUERY, ()),
+    (CLAIM_OUTBOX_QUERY, (0, 1, 0, 100)),
+    (MARK_SENDING_QUERY, (0,)),
+    (OUTBOX_DONE_QUERY, (0,)),
+    (OUTBOX_RETRY_QUERY, (0, 0, '', 0)),
+    (OUTBOX_DEAD_QUERY, (0, '', 0)),
+    (COUNT_OUTBOX_QUERY, ('pending',)),
+    (DEAD_LETTERS_QUERY, (20,)),
+    (REQUEUE_DEAD_QUERY, (0,)),
+    (REQUEUE_DEAD_ROW_QUERY, (0, 0)),
+    (PURGE_DEAD_QUERY, (0,)),
+    (ANALYTICS_SINCE_QUERY, ('',)),
+    (SERIES_RANGE_QUERY, (0, 1, 0, 0, '')),
+    (ROLLUP_SERIES_QUERY, (3600, 3600, 60, 0)),
+    (DELETE_SERIES_QUERY, (60, 0)),
+]
+
+def check_query_plans(conn, queries=INDEXED_QUERIES):
+    """Повертає список (запит, крок плану) для запитів, що скатилися до повного сканування.
+
+    Викликається з tests/test_query_plans.py, а не під час запуску бота.
+    """
+    problems = []
+    for query, params in queries:
+        for row in conn.execute("EXPLAIN QUERY PLAN " + query, params):
+            detail = row[-1]
+            # "SCAN ... USING INDEX" теж обходить увесь індекс; потрібен SEARCH
+            if detail.startswith("SCAN"):
+                problems.append((query, detail))
+    return problems
+
+async def init_db():
+    await db.run(_migrate)
 
-def get_channels():
-    channels = execute_db("SELECT * FROM channels")
-    return {channel[1]: {'id': channel[0], 'expiry_date': channel[2]} for channel in channels}
+# Функції для роботи з базою даних
+async def execute_db(query, params=()):
+    return await db.execute(query, params)
 
-def get_filters():
-    filters = execute_db("SELECT * FROM filters")
-    return filters
+# Кеш конфігурації маршрутизації
+@dataclass(frozen=True)
+class RoutingConfig:
+    """Незмінний знімок каналів, фільтрів, адміністраторів і налаштувань.
+
+    Гарячий шлях читає лише поточний знімок; після кожної зміни в БД
+    будується новий знімок і атомарно підміняє попередній.
+    """
+    version: int
+    db_version: int
+    channels: MappingProxyType
+    filters: tuple
+    admins: MappingProxyType
+    admin_ids: frozenset
+    main_channels: MappingProxyType
+    spam_settings: tuple
+    matcher: "FilterMatcher"
+
+_config_versions = itertools.count(1)
+_config = None
+
+def _load_config(conn, previous=None):
+    channels = conn.execute("SELECT * FROM channels").fetchall()
+    filters = tuple(conn.execute("SELECT * FROM filters").fetchall())
+    admins = conn.execute("SELECT * FROM admins").fetchall()
+    main_channels = conn.execute("SELECT * FROM main_channels").fetchall()
+    settings = conn.execute("SELECT * FROM spam_settings").fetchall()
+    db_version = conn.execute(CONFIG_VERSION_QUERY).fetchone()[0]
 
-def get_admins():
-    admins = execute_db("SELECT * FROM admins")
     admin_dict = {str(admin[0]): admin[1] for admin in admins}
     if str(SUPERADMIN_ID) not in admin_dict:
-        execute_db("INSERT OR REPLACE INTO admins (user_id, role) VALUES (?, ?)", (SUPERADMIN_ID, 'superadmin'))
+        conn.execute("INSERT OR REPLACE INTO admins (user_id, role) VALUES (?, ?)", (SUPERADMIN_ID, 'superadmin'))
         admin_dict[str(SUPERADMIN_ID)] = 'superadmin'
-    return admin_dict
 
-def get_main_channels():
-    main_channels = execute_db("SELECT * FROM main_channels")
-    return {str(channel[0]): True for channel in main_channels}
+    # Побудова матчера — найдорожча частина; зміна адмінів, налаштувань тощо
+    # не торкається фільтрів, тож матчер попереднього знімка придатний далі
+    if previous is not None and previous.filters == filters:
+        matcher = previous.matcher
+    else:
+        matcher = FilterMatcher(filters)
+
+    return RoutingConfig(
+        version=next(_config_versions),
+        db_version=db_version,
+        channels=MappingProxyType({channel[1]: {'id': channel[0], 'expiry_date': channel[2]} for channel in channels}),
+        filters=filters,
+        admins=MappingProxyType(admin_dict),
+        admin_ids=frozenset(int(user_id) for user_id in admin_dict),
+        main_channels=MappingProxyType({str(channel[0]): True for channel in main_channels}),
+        spam_settings=settings[0] if settings else None,
+        matcher=matcher,
+    )
+
+async def load_config():
+    """Зчитує з БД повний знімок конфігурації в межах однієї транзакції."""
+    return await db.run(_load_config, _config)
+
+async def reload_config():
+    """Перечитує конфігурацію з БД і атомарно підміняє поточний знімок."""
+    global _config
+    _config = await load_config()
+    spam_detector.configure(_config.spam_settings)
+    return _config
+
+async def config_changed():
+    """Перечитує конфігурацію після зміни і сповіщає про неї інші процеси кластера."""
+    await execute_db("UPDATE meta SET value = value + 1 WHERE key = 'config_version'")
+    return await reload_config()
+
+def get_config():
+    return _config
 
-def get_spam_settings():
-    settings = execute_db("SELECT * FROM spam_settings")
-    return settings[0] if settings else None
+def get_channels():
+    return _config.channels
 
-# Декоратори для перевірки прав доступу
-def admin_required(func):
-    @wraps(func)
-    async def wrapper(message: types.Message, *args, **kwargs):
-        user_id = message.from_user.id
-        admins = get_admins()
-        if str(user_id) not in admins:
-            await message.reply("У вас немає прав для виконання цієї команди.")
-            return
-        return await func(message, *args, **kwargs)
-    return wrapper
+def get_filters():
+    return _config.filters
 
-def superadmin_required(func):
-    @wraps(func)
-    async def wrapper(message: types.Message, *args, **kwargs):
-        user_id = message.from_user.id
-        if user_id != SUPERADMIN_ID:
-            await message.reply("Ця команда доступна тільки для суперадміністратора.")
-            return
-        return await func(message, *args, **kwargs)
-    return wrapper
+def get_admins():
+    return _config.admins
+
+def get_main_channels():
+    return _config.main_channels
+
+def get_spam_settings():
+    return _config.spam_settings
+
+# Маршрутизація команд і кнопок
+# Команди й кнопки реєструються в словниках і знаходяться за текстом
+# повідомлення одним пошуком, тож вартість маршрутизації не залежить від
+# їх кількості. Рівень доступу задається при реєстрації й перевіряється
+# AuthMiddleware до виклику хендлера.
+@dataclass(frozen=True)
+class Route:
+    callback: object
+    access: str  # 'admin' або 'superadmin'
+
+_commands = {}
+_buttons = {}
+
+def command(name, access='admin'):
+    """Реєструє хендлер команди /name."""
+    def decorator(func):
+        _commands[name] = Route(func, access)
+        return func
+    return decorator
+
+def button(text, access='admin'):
+    """Реєструє хендлер кнопки клавіатури з текстом text."""
+    def decorator(func):
+        _buttons[text] = Route(func, access)
+        return func
+    return decorator
+
+class RouteFilter(Filter):
+    """Знаходить маршрут для повідомлення і передає його хендлеру як route."""
+
+    async def __call__(self, message: types.Message):
+        text = message.text
+        if not text:
+            return False
+        route = _buttons.get(text)
+        if route is None and text.startswith('/'):
+            name, _, mention = text.split(maxsplit=1)[0][1:].partition('@')
+            route = _commands.get(name)
+            if route is not None and mention and mention.lower() != (await message.bot.me()).username.lower():
+                # Команда адресована іншому боту в групі
+                return False
+        return {'route': route} if route is not None else False
+
+def is_authorized(user_id, access):
+    if access == 'superadmin':
+        return user_id == SUPERADMIN_ID
+    return user_id in get_config().admin_ids
+
+class AuthMiddleware(BaseMiddleware):
+    """Перевіряє права користувача за кешованим набором адміністраторів."""
+
+    DENIED = {
+        'admin': "У вас немає прав для виконання цієї команди.",
+        'superadmin': "Ця команда доступна тільки для суперадміністратора.",
+    }
+
+    async def __call__(self, handler, event, data):
+        route = data.get("route")
+        if route is not None:
+            user = event.from_user
+            if user is None or not is_authorized(user.id, route.access):
+                await event.reply(self.DENIED[route.access])
+                return
+        return await handler(event, data)
+
+dp.message.middleware(AuthMiddleware())
+
+@dp.message(RouteFilter())
+async def route_message(message: types.Message, route: Route):
+    await route.callback(message)
 
 # Функції для роботи з каналами та фільтрами
-def add_channel(channel_id, days):
+async def add_channel(channel_id, days):
     expiry_date = (datetime.now() + timedelta(days=days)).isoformat()
-    execute_db("INSERT INTO channels (channel_id, expiry_date) VALUES (?, ?)", (channel_id, expiry_date))
+    await execute_db("INSERT INTO channels (channel_id, expiry_date) VALUES (?, ?) ON CONFLICT(channel_id) DO UPDATE SET expiry_date = excluded.expiry_date",
+                     (channel_id, expiry_date))
+    await config_changed()
+    schedule_channel_expiry(channel_id, expiry_date)
+
+def _remove_channel(conn, channel_id):
+    conn.execute(DELETE_CHANNEL_QUERY, (channel_id,))
+    conn.execute(DELETE_CHANNEL_FILTERS_QUERY, (channel_id,))
+
+async def remove_channel(channel_id):
+    await db.run(_remove_channel, channel_id)
+    await config_changed()
+    unschedule_channel_expiry(channel_id)
+
+async def add_filter(channel_id, filter_type, filter_value):
+    await execute_db("INSERT INTO filters (channel_id, filter_type, filter_value) VALUES (?, ?, ?)",
+               (channel_id, filter_type, filter_value))
+    await config_changed()
+
+async def remove_filter(filter_id):
+    await execute_db(DELETE_FILTER_QUERY, (filter_id,))
+    await config_changed()
+
+# Компільований матчер фільтрів
+def _is_word_char(ch):
+    # Те саме визначення, що й у \w модуля re для рядків
+    return ch.isalnum() or ch == '_'
+
+def _is_word_boundary(text, pos):
+    before = pos > 0 and _is_word_char(text[pos - 1])
+    after = pos < len(text) and _is_word_char(text[pos])
+    return before != after
+
+def _matches_filter(text, filter_type, filter_value):
+    """Перевіряє один фільтр напряму (використовується для вироджених значень)."""
+    if filter_type == 'phrase':
+        return filter_value.lower() in text
+    if filter_type == 'word':
+        return re.search(r'\b' + re.escape(filter_value.lower()) + r'\b', text) is not None
+    if filter_type == 'combination':
+        return all(element.strip().lower() in text for element in filter_value.split('&'))
+    return False
 
-def remove_channel(channel_id):
-    execute_db("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
-    execute_db("DELETE FROM filters WHERE channel_id = ?", (channel_id,))
+def normalize_hashtag(tag):
+    return tag.strip().lstrip('#').lower()
 
-def add_filter(channel_id, filter_type, filter_value):
-    execute_db("INSERT INTO filters (channel_id, filter_type, filter_value) VALUES (?, ?, ?)",
-               (channel_id, filter_type, filter_value))
+def extract_hashtags(message: types.Message):
+    """Повертає хештеги з entities/caption_entities, які Telegram уже розмітив."""
+    if message.text:
+        text, entities = message.text, message.entities
+    else:
+        text, entities = message.caption, message.caption_entities
+    if not text or not entities:
+        return []
+    return [entity.extract_from(text) for entity in entities if entity.type == 'hashtag']
+
+class FilterMatcher:
+    """Автомат Ахо-Корасік над усіма фільтрами.
+
+    Будується один раз із таблиці filters і за один прохід по тексту
+    повертає множину ID фільтрів, що спрацювали (або їхніх каналів). Фільтри
+    tag перевіряються окремо через словник хештегів, тож їхня вартість
+    залежить лише від кількості хештегів у пості.
+    """
 
-def remove_filter(filter_id):
-    execute_db("DELETE FROM filters WHERE id = ?", (filter_id,))
+    def __init__(self, filters):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        self._keywords = {}
+        self._lengths = []
+        self._channels = {}     # фільтр -> канал
+        self._tags = {}         # нормалізований хештег -> фільтри
+        self._direct = {}       # ключ -> фільтри (phrase)
+        self._words = {}        # ключ -> фільтри (word, з перевіркою меж слова)
+        self._combos = []       # (фільтр, кількість різних елементів)
+        self._combo_index = {}  # ключ -> індекси комбінацій
+        self._always = set()
+        self._fallback = []
+
+        for filter_id, channel_id, filter_type, filter_value in filters:
+            self._channels[filter_id] = channel_id
+            if filter_type == 'tag':
+                tag = normalize_hashtag(filter_value)
+                if tag:
+                    self._tags.setdefault(tag, set()).add(filter_id)
+            elif filter_type == 'phrase':
+                value = filter_value.lower()
+                if value:
+                    self._direct.setdefault(self._add_keyword(value), set()).add(filter_id)
+                else:
+                    self._always.add(filter_id)
+            elif filter_type == 'word':
+                value = filter_value.lower()
+                if value:
+                    self._words.setdefault(self._add_keyword(value), set()).add(filter_id)
+                else:
+                    self._fallback.append((filter_id, filter_type, filter_value))
+            elif filter_type == 'combination':
+                elements = {element.strip().lower() for element in filter_value.split('&')}
+                elements.discard('')
+                if not elements:
+                    self._always.add(filter_id)
+                    continue
+                combo_idx = len(self._combos)
+                self._combos.append((filter_id, len(elements)))
+                for element in elements:
+                    self._combo_index.setdefault(self._add_keyword(element), []).append(combo_idx)
+
+        self._build_links()
+
+    def _add_keyword(self, keyword):
+        kw_id = self._keywords.get(keyword)
+        if kw_id is not None:
+            return kw_id
+        kw_id = len(self._lengths)
+        self._keywords[keyword] = kw_id
+        self._lengths.append(len(keyword))
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            node = nxt
+        self._out[node] = self._out[node] + (kw_id,)
+        return kw_id
+
+    def _build_links(self):
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+                queue.append(child)
+
+    def match(self, text, hashtags=()):
+        """Повертає множину ID каналів, для яких спрацював хоча б один фільтр."""
+        return self.channels_of(self.match_filters(text, hashtags))
+
+    def channels_of(self, filter_ids):
+        channels = self._channels
+        return {channels[filter_id] for filter_id in filter_ids}
+
+    def match_filters(self, text, hashtags=()):
+        """Повертає множину ID фільтрів, що спрацювали."""
+        text = text.lower()
+        goto, fail, out = self._goto, self._fail, self._out
+        words, lengths = self._words, self._lengths
+        found = set()
+        words_found = set()
+        node = 0
+        for pos, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if not out[node]:
+                continue
+            for kw_id in out[node]:
+                found.add(kw_id)
+                if kw_id in words and kw_id not in words_found:
+                    end = pos + 1
+                    if _is_word_boundary(text, end - lengths[kw_id]) and _is_word_boundary(text, end):
+                        words_found.add(kw_id)
+
+        matched = set(self._always)
+        for tag in hashtags:
+            filter_ids = self._tags.get(normalize_hashtag(tag))
+            if filter_ids:
+                matched |= filter_ids
+        combo_hits = {}
+        for kw_id in found:
+            filter_ids = self._direct.get(kw_id)
+            if filter_ids:
+                matched |= filter_ids
+            for combo_idx in self._combo_index.get(kw_id, ()):
+                combo_hits[combo_idx] = combo_hits.get(combo_idx, 0) + 1
+        for kw_id in words_found:
+            matched |= words[kw_id]
+        for combo_idx, hits in combo_hits.items():
+            filter_id, needed = self._combos[combo_idx]
+            if hits == needed:
+                matched.add(filter_id)
+        for filter_id, filter_type, filter_value in self._fallback:
+            if _matches_filter(text, filter_type, filter_value):
+                matched.add(filter_id)
+        return matched
 
 # Функції для роботи з адміністраторами
-def add_admin(user_id, role='admin'):
-    execute_db("INSERT OR REPLACE INTO admins (user_id, role) VALUES (?, ?)", (user_id, role))
+async def add_admin(user_id, role='admin'):
+    await execute_db("INSERT OR REPLACE INTO admins (user_id, role) VALUES (?, ?)", (user_id, role))
+    await config_changed()
 
 # Функції для роботи з основними каналами
-def add_main_channel(channel_id):
-    execute_db("INSERT OR REPLACE INTO main_channels (channel_id) VALUES (?)", (channel_id,))
+async def add_main_channel(channel_id):
+    await execute_db("INSERT OR REPLACE INTO main_channels (channel_id) VALUES (?)", (channel_id,))
+    await config_changed()
 
-def remove_main_channel(channel_id):
-    execute_db("DELETE FROM main_channels WHERE channel_id = ?", (channel_id,))
+async def remove_main_channel(channel_id):
+    await execute_db("DELETE FROM main_channels WHERE channel_id = ?", (channel_id,))
+    await config_changed()
 
 # Функції для роботи з налаштуваннями спаму
-def set_spam_settings(max_messages, time_window):
-    execute_db("INSERT OR REPLACE INTO spam_settings (id, max_messages, time_window) VALUES (1, ?, ?)",
+async def set_spam_settings(max_messages, time_window):
+    await execute_db("INSERT OR REPLACE INTO spam_settings (id, max_messages, time_window) VALUES (1, ?, ?)",
                (max_messages, time_window))
+    await config_changed()
+
+SPAM_MAX_TRACKED_USERS = int(os.getenv("SPAM_MAX_TRACKED_USERS", 100000))
+
+class SpamDetector:
+    """Ковзне вікно для кожного відправника на кільцевому буфері з max_messages міток часу.
+
+    Перевірка коштує O(1): повідомлення є спамом, якщо буфер заповнений і
+    найстаріша мітка ще в межах time_window. Користувачі зберігаються в
+    порядку останньої активності, тож неактивні витісняються з початку.
+    """
+
+    def __init__(self, max_users=SPAM_MAX_TRACKED_USERS):
+        self.max_users = max_users
+        self.max_messages = None
+        self.time_window = None
+        self._users = OrderedDict()
+        self.checked = 0
+        self.blocked = 0
+        self.evicted = 0
+
+    def configure(self, settings):
+        """Застосовує рядок spam_settings; при зміні лімітів стан скидається."""
+        max_messages, time_window = (settings[1], settings[2]) if settings else (None, None)
+        if (max_messages, time_window) != (self.max_messages, self.time_window):
+            self.max_messages, self.time_window = max_messages, time_window
+            self._users.clear()
+
+    def check(self, user_id, now=None):
+        if not self.max_messages or not self.time_window:
+            return False
+        now = time.monotonic() if now is None else now
+        self.checked += 1
+        window = self._users.get(user_id)
+        if window is None:
+            window = self._users[user_id] = deque(maxlen=self.max_messages)
+        else:
+            self._users.move_to_end(user_id)
+        spam = len(window) == self.max_messages and now - window[0] < self.time_window
+        window.append(now)
+        if spam:
+            self.blocked += 1
+        self._evict(now)
+        return spam
+
+    def _evict(self, now):
+        users = self._users
+        while users:
+            user_id, window = next(iter(users.items()))
+            if len(users) <= self.max_users and now - window[-1] < self.time_window:
+                break
+            del users[user_id]
+            self.evicted += 1
+
+    def stats(self):
+        tracked = len(self._users)
+        per_user = sys.getsizeof(deque(maxlen=self.max_messages or 1)) + (self.max_messages or 0) * sys.getsizeof(0.0)
+        return {
+            'tracked_users': tracked,
+            'memory_bytes': sys.getsizeof(self._users) + tracked * per_user,
+            'checked': self.checked,
+            'blocked': self.blocked,
+            'evicted': self.evicted,
+        }
+
+spam_detector = SpamDetector()
 
 def is_spam(user_id):
-    # Реалізуйте логіку перевірки спаму
-    return False
+    return spam_detector.check(user_id)
+
+def spam_sender(message):
+    """Ключ відправника для SpamDetector або None, якщо автора не видно.
+
+    У channel_post поле from порожнє, тож відправником вважається підпис
+    автора (author_signature) у межах каналу. Непідписані пости ліміту не
+    підлягають: інакше весь канал рахувався б одним відправником, і його
+    звичайні пости відкидалися б у години пік.
+    """
+    if message.from_user:
+        return message.from_user.id
+    if message.author_signature:
+        chat = message.sender_chat or message.chat
+        return (chat.id, message.author_signature)
+    return None
 
 # Функції для роботи з аналітикою
+# Лічильники накопичуються в пам'яті та скидаються в БД не рідше ніж раз на інтервал
+ANALYTICS_FLUSH_INTERVAL = int(os.getenv("ANALYTICS_FLUSH_INTERVAL", 30))
+# Часові ряди пишуться хвилинними кошиками; старші за ANALYTICS_MINUTE_DAYS
+# зводяться в години, старші за ANALYTICS_HOUR_DAYS — у дні (зберігаються без обмежень)
+ANALYTICS_MINUTE_DAYS = int(os.getenv("ANALYTICS_MINUTE_DAYS", 2))
+ANALYTICS_HOUR_DAYS = int(os.getenv("ANALYTICS_HOUR_DAYS", 30))
+ANALYTICS_MAX_DAYS = 366
+ANALYTICS_TOP = 10
+MINUTE, HOUR, DAY = 60, 3600, 86400
+_analytics_buffer = Counter()
+_series_buffer = Counter()
+_analytics_version = 0
+
 def log_action(action):
     date = datetime.now().strftime('%Y-%m-%d')
-    execute_db("INSERT INTO analytics (date, action, count) VALUES (?, ?, 1) ON CONFLICT(date, action) DO UPDATE SET count = count + 1",
-               (date, action))
+    _analytics_buffer[(date, action)] += 1
 
-def get_analytics():
-    return execute_db("SELECT * FROM analytics ORDER BY date DESC LIMIT 30")
+def record_series(kind, keys):
+    """Додає по одній події для кожного ключа до поточного хвилинного кошика.
+
+    kind: 'matched' і 'forwarded' (ключ — канал) або 'filter' (ключ — ID фільтра).
+    """
+    now = int(time.time())
+    bucket = now - now % MINUTE
+    for key in keys:
+        _series_buffer[(bucket, kind, key)] += 1
+
+def _write_analytics(conn, rows, series=()):
+    conn.executemany("INSERT INTO analytics (date, action, count) VALUES (?, ?, ?) ON CONFLICT(date, action) DO UPDATE SET count = count + excluded.count",
+                     rows)
+    conn.executemany("INSERT INTO analytics_series (resolution, bucket, kind, key, count) VALUES (60, ?, ?, ?, ?) "
+                     "ON CONFLICT(resolution, bucket, kind, key) DO UPDATE SET count = count + excluded.count",
+                     series)
+
+async def flush_analytics():
+    """Записує накопичені лічильники й кошики часових рядів однією транзакцією."""
+    global _analytics_buffer, _series_buffer, _analytics_version
+    if not (_analytics_buffer or _series_buffer):
+        return
+    pending, _analytics_buffer = _analytics_buffer, Counter()
+    series, _series_buffer = _series_buffer, Counter()
+    try:
+        await db.run(_write_analytics,
+                     [(date, action, count) for (date, action), count in pending.items()],
+                     [(bucket, kind, key, count) for (bucket, kind, key), count in series.items()])
+        _analytics_version += 1
+    except Exception as e:
+        # Повертаємо лічильники в буфер, щоб не втратити їх до наступної спроби
+        _analytics_buffer.update(pending)
+        _series_buffer.update(series)
+        logger.error(f"Failed to flush analytics: {e}")
+
+def _rollup_series(conn, source, target, before):
+    # Додаємо суми до кошиків грубішої роздільності й видаляємо зведені
+    conn.execute(ROLLUP_SERIES_QUERY, (target, target, source, before))
+    return conn.execute(DELETE_SERIES_QUERY, (source, before)).rowcount
+
+def _rollup_analytics(conn, now):
+    minutes = _rollup_series(conn, MINUTE, HOUR, (now - ANALYTICS_MINUTE_DAYS * DAY) // HOUR * HOUR)
+    hours = _rollup_series(conn, HOUR, DAY, (now - ANALYTICS_HOUR_DAYS * DAY) // DAY * DAY)
+    return minutes, hours
+
+async def rollup_analytics():
+    """Знижує роздільність старих кошиків: хвилини -> години -> дні."""
+    await flush_analytics()
+    minutes, hours = await db.run(_rollup_analytics, int(time.time()))
+    if minutes or hours:
+        logger.info(f"Analytics rollup: {minutes} minute and {hours} hour buckets downsampled")
+
+async def get_analytics(days=30):
+    """Денні лічильники дій за останні days днів."""
+    await flush_analytics()
+    since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    return await execute_db(ANALYTICS_SINCE_QUERY, (since,))
+
+def _query_series(conn, kind, start, end, step):
+    # Сумуємо в SQLite до кроку графіка, щоб не тягнути в Python хвилинні кошики;
+    # умова на resolution дає пошук за первинним ключем замість сканування
+    return conn.execute(SERIES_RANGE_QUERY, (start, step, start, end, kind)).fetchall()
+
+async def get_analytics_report(days=30):
+    """Збирає дані для /analytics: дії по днях і ряди каналів та фільтрів."""
+    await flush_analytics()
+    # До трьох днів показуємо погодинно, далі — по днях (UTC)
+    step = HOUR if days <= 3 else DAY
+    end = (int(time.time()) // step + 1) * step
+    start = end - days * DAY
+    return {
+        'days': days,
+        'start': start,
+        'step': step,
+        'bins': (end - start) // step,
+        'actions': await get_analytics(days),
+        'series': {kind: await db.run(_query_series, kind, start, end, step)
+                   for kind in ('forwarded', 'matched', 'filter')},
+        'filters': {row[0]: row for row in get_filters()},
+    }
+
+def aggregate_series(rows, bins, top=ANALYTICS_TOP):
+    """Зводить рядки (інтервал, ключ, кількість) у матрицю [ключ x інтервал].
+
+    Повертає top ключів за загальною сумою, їхню матрицю та суму по всіх ключах.
+    """
+    import numpy as np
+
+    if not rows:
+        return [], np.zeros((0, bins), dtype=np.int64), 0
+    data = np.array(rows, dtype=np.int64)
+    keys, inverse = np.unique(data[:, 1], return_inverse=True)
+    index = np.clip(data[:, 0], 0, bins - 1)
+    matrix = np.bincount(inverse * bins + index, weights=data[:, 2],
+                         minlength=len(keys) * bins).reshape(len(keys), bins).astype(np.int64)
+    totals = matrix.sum(axis=1)
+    order = np.argsort(totals, kind='stable')[::-1][:top]
+    return keys[order].tolist(), matrix[order], int(totals.sum())
+
+# Побудова графіків аналітики
+# Рендеринг виконується поза циклом подій; готовий PNG кешується до зміни даних
+_chart_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart")
+_chart_cache = {}
+
+def _filter_label(filters, filter_id):
+    row = filters.get(filter_id)
+    if row is None:
+        return f"#{filter_id} (видалено)"
+    value = row[3] if len(row[3]) <= 20 else row[3][:19] + "…"
+    return f"#{filter_id} {row[2]}: {value}"
+
+def render_analytics_chart(report):
+    """Будує графік і підпис до нього; повертає (png, caption).
+
+    Використовує об'єктний API matplotlib (без глобального стану pyplot).
+    """
+    from matplotlib.figure import Figure
+
+    start, step, bins = report['start'], report['step'], report['bins']
+    times = [datetime.fromtimestamp(start + i * step) for i in range(bins)]
+    fig = Figure(figsize=(10, 12))
+    ax_actions, ax_channels, ax_filters = fig.subplots(3, 1)
+
+    data = report['actions']
+    actions = sorted(set(row[1] for row in data))
+    for action in actions:
+        action_data = sorted(row for row in data if row[1] == action)
+        dates = [datetime.strptime(row[0], '%Y-%m-%d').date() for row in action_data]
+        counts = [row[2] for row in action_data]
+        ax_actions.plot(dates, counts, marker=".", label=action)
+    ax_actions.set_title("Аналітика використання бота")
+    ax_actions.set_ylabel("Кількість дій")
+    if actions:
+        ax_actions.legend(fontsize='small')
+
+    channels, forwarded, forwarded_total = aggregate_series(report['series']['forwarded'], bins)
+    for channel_id, counts in zip(channels, forwarded):
+        ax_channels.plot(times, counts, label=str(channel_id))
+    ax_channels.set_title(f"Пересилання по каналах (топ {ANALYTICS_TOP})")
+    ax_channels.set_ylabel("Пересилань")
+    if channels:
+        ax_channels.legend(fontsize='small')
+
+    filter_ids, matched, matched_total = aggregate_series(report['series']['filter'], bins)
+    labels = [_filter_label(report['filters'], filter_id) for filter_id in filter_ids]
+    for label, counts in zip(labels, matched):
+        ax_filters.plot(times, counts, label=label)
+    ax_filters.set_title(f"Спрацювання фільтрів (топ {ANALYTICS_TOP})")
+    ax_filters.set_ylabel("Збігів")
+    if filter_ids:
+        ax_filters.legend(fontsize='small')
+
+    for ax in (ax_actions, ax_channels, ax_filters):
+        ax.set_xlim(times[0], datetime.fromtimestamp(start + bins * step))
+        ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+
+    _, _, targeted_total = aggregate_series(report['series']['matched'], bins, top=0)
+    lines = [f"Аналітика за {report['days']} дн.: переслано {forwarded_total} "
+             f"з {targeted_total} призначених, спрацювань фільтрів {matched_total}."]
+    if channels:
+        lines.append("Канали: " + ", ".join(f"{channel_id} — {int(counts.sum())}"
+                                            for channel_id, counts in zip(channels[:5], forwarded)))
+    if filter_ids:
+        lines.append("Фільтри: " + ", ".join(f"{label} — {int(counts.sum())}"
+                                             for label, counts in zip(labels[:5], matched)))
+    return buf.getvalue(), "\n".join(lines)[:1024]
+
+async def get_analytics_chart(days=30):
+    """Повертає (PNG, підпис) з аналітикою, перебудовуючи їх лише після появи нових даних."""
+    await flush_analytics()
+    # Інші процеси кластера пишуть свої лічильники самі, тому кеш живе
+    # не довше за інтервал скидання
+    key = (_analytics_version, days, int(time.time() // ANALYTICS_FLUSH_INTERVAL))
+    chart = _chart_cache.get(key)
+    if chart is None:
+        report = await get_analytics_report(days)
+        loop = asyncio.get_running_loop()
+        chart = await loop.run_in_executor(_chart_executor, render_analytics_chart, report)
+        _chart_cache.clear()
+        _chart_cache[key] = chart
+    return chart
+
+# Розсилання з обмеженням швидкості
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", 30))       # повідомлень на секунду для всього бота
+GLOBAL_SEND_RATE /= SHARD_COUNT                                      # у кластері ліміт ділиться між процесами
+GLOBAL_SEND_BURST = int(os.getenv("GLOBAL_SEND_BURST", 1))          # понад швидкість, щоб не перевищити ліміт Telegram
+CHAT_SEND_RATE = float(os.getenv("CHAT_SEND_RATE", 20 / 60))      # повідомлень на секунду в один чат
+CHAT_SEND_BURST = int(os.getenv("CHAT_SEND_BURST", 3))
+FORWARD_CONCURRENCY = int(os.getenv("FORWARD_CONCURRENCY", 16))
+FORWARD_MAX_RETRIES = int(os.getenv("FORWARD_MAX_RETRIES", 5))
+
+class TokenBucket:
+    """Відро токенів з резервуванням: кожен виклик acquire отримує свій слот у часі."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.generation = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Забирає токен і повертає, скільки секунд треба зачекати до його появи."""
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds):
+        """Не видає токенів найближчі seconds секунд (наприклад, після TelegramRetryAfter)."""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.generation += 1
+
+    async def acquire(self):
+        while True:
+            generation = self.generation
+            delay = self.reserve()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+            # Якщо під час очікування відро призупинили, слот недійсний
+            if generation == self.generation:
+                return
+
+    def is_idle(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+class FanOut:
+    """Паралельне надсилання в канали з глобальним і поканальним обмеженням швидкості."""
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate=GLOBAL_SEND_RATE, chat_rate=CHAT_SEND_RATE,
+                 chat_burst=CHAT_SEND_BURST, concurrency=FORWARD_CONCURRENCY,
+                 max_retries=FORWARD_MAX_RETRIES, global_burst=GLOBAL_SEND_BURST):
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._max_retries = max_retries
+        self.queued = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.is_idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    async def send(self, chat_id, call):
+        """Виконує call() для chat_id з урахуванням лімітів; RetryAfter перепланує виклик."""
+        attempt = 0
+        while True:
+            bucket = self._chat_bucket(chat_id)
+            self.queued += 1
+            try:
+                await bucket.acquire()
+                await self._global.acquire()
+                await self._semaphore.acquire()
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+            try:
+                result = await call()
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self.retries += 1
+                metrics.inc('retry_after_total', chat=chat_id)
+                bucket.pause(e.retry_after)
+                logger.warning(f"Flood control for chat {chat_id}, retry in {e.retry_after}s (attempt {attempt})")
+                if attempt > self._max_retries:
+                    self.failed += 1
+                    raise
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.in_flight -= 1
+                self._semaphore.release()
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'chats': len(self._chats),
+        }
+
+fanout = FanOut()
+
+metrics.gauge('fanout_queued', lambda: fanout.queued)
+metrics.gauge('fanout_in_flight', lambda: fanout.in_flight)
+metrics.gauge('spam_tracked_users', lambda: spam_detector.stats()['tracked_users'])
+metrics.gauge('config_version', lambda: _config.version if _config else 0)
+metrics.gauge('event_loop_lag_last_seconds', lambda: metrics.last_loop_lag)
 
 # Створення клавіатури з кнопками
 def get_admin_keyboard() -> ReplyKeyboardMarkup:
@@ -177,15 +1288,13 @@ def get_admin_keyboard() -> ReplyKeyboardMarkup:
         resize_keyboard=True)
 
 # Команди бота
-@dp.message(Command("start"))
-@admin_required
+@command("start")
 async def start(message: types.Message):
     keyboard = get_admin_keyboard()
     await message.reply("Вітаю! Я бот для пересилання повідомлень. Використовуйте кнопки нижче для керування.", reply_markup=keyboard)
     log_action("start")
 
-@dp.message(Command("help"))
-@admin_required
+@command("help")
 async def help_command(message: types.Message):
     help_text = """
     Доступні команди:
@@ -197,6 +1306,8 @@ async def help_command(message: types.Message):
     /add_filter channel_id filter_type filter_value - Додати фільтр до каналу
     /remove_filter filter_id - Видалити фільтр
     /list_filters - Показати список фільтрів
+    /export_channels [csv|json], /export_filters [csv|json] - Вивантажити канали або фільтри файлом
+    /import_channels [replace], /import_filters [replace] - Завантажити канали або фільтри з файлу CSV/JSON (відповіддю на файл)
     /set_admin user_id role - Встановити адміністратора (тільки для суперадміна)
     /list_admins - Показати список адміністраторів
     /add_main_channel channel_id - Додати основний канал (тільки для суперадміна)
@@ -204,45 +1315,48 @@ async def help_command(message: types.Message):
     /list_main_channels - Показати список основних каналів
     /set_spam_settings max_messages time_window - Встановити налаштування захисту від спаму (тільки для суперадміна)
     /get_spam_settings - Показати поточні налаштування захисту від спаму
-    /get_logs - Отримати файл логів (тільки для суперадміна)
-    /analytics - Показати аналітику використання бота
+    /get_logs [lines=N] [since=T] [until=T] [level=L] - Отримати стиснений витяг з логів (тільки для суперадміна)
+    /analytics [days] - Показати аналітику за days днів (за замовчуванням 30)
+    /stats - Показати метрики продуктивності (тільки для суперадміна)
+    /dead_letters - Показати пересилання, що вичерпали спроби (тільки для суперадміна)
+    /retry_dead [all | ID ...] - Повернути такі пересилання в чергу (тільки для суперадміна)
+    /purge_dead [днів] - Видалити такі пересилання, старші за вказану кількість днів (тільки для суперадміна)
+    /backup - Створити резервну копію бази даних (тільки для суперадміна)
+    /restore - Відновити дані з копії, відповівши на повідомлення з файлом (тільки для суперадміна)
     """
     await message.reply(help_text)
     log_action("help")
 
-@dp.message(lambda message: message.text == "📊 Список каналів")
-@admin_required
+@button("📊 Список каналів")
+@command("list_channels")
 async def list_channels_button(message: types.Message):
     channels = get_channels()
     if channels:
-        channel_list = "\n".join([f"{channel_id}: до {info['expiry_date']}" for channel_id, info in channels.items()])
-        await message.reply(f"Список активних каналів:\n{channel_list}")
+        lines = [f"{channel_id}: до {info['expiry_date']}" for channel_id, info in channels.items()]
+        for chunk in split_text(lines, header="Список активних каналів:"):
+            await message.reply(chunk)
     else:
         await message.reply("Список активних каналів порожній.")
     log_action("list_channels")
 
-@dp.message(lambda message: message.text == "➕ Додати канал")
-@admin_required
+@button("➕ Додати канал")
 async def add_channel_button(message: types.Message):
     await message.reply("Для додавання каналу використовуйте команду:\n/add_channel channel_id days")
 
-@dp.message(lambda message: message.text == "➖ Видалити канал")
-@admin_required
+@button("➖ Видалити канал")
 async def remove_channel_button(message: types.Message):
     await message.reply("Для видалення каналу використовуйте команду:\n/remove_channel channel_id")
 
-@dp.message(lambda message: message.text == "🏷 Додати фільтр")
-@admin_required
+@button("🏷 Додати фільтр")
 async def add_filter_button(message: types.Message):
     await message.reply("Для додавання фільтру використовуйте команду:\n/add_filter channel_id filter_type filter_value (filter_type = tag, word, phrase, combination)")
 
-@dp.message(lambda message: message.text == "🗑 Видалити фільтр")
-@admin_required
+@button("🗑 Видалити фільтр")
 async def remove_filter_button(message: types.Message):
     await message.reply("Для видалення фільтру використовуйте команду:\n/remove_filter filter_id")
 
-@dp.message(lambda message: message.text == "👥 Список адміністраторів")
-@admin_required
+@button("👥 Список адміністраторів")
+@command("list_admins")
 async def list_admins_button(message: types.Message):
     admins = get_admins()
     if admins:
@@ -252,156 +1366,472 @@ async def list_admins_button(message: types.Message):
         await message.reply("Список адміністраторів порожній.")
     log_action("list_admins")
 
-@dp.message(lambda message: message.text == "📈 Аналітика")
-@admin_required
+@button("📈 Аналітика")
 async def analytics_button(message: types.Message):
     await analytics_command(message)
 
-@dp.message(lambda message: message.text == "📋 Допомога")
-@admin_required
+@button("📋 Допомога")
 async def help_button(message: types.Message):
     await help_command(message)
 
-@dp.message(Command("add_channel"))
-@admin_required
+@command("add_channel")
 async def add_channel_command(message: types.Message):
     try:
         _, channel_id, days = message.text.split()
-        add_channel(int(channel_id), int(days))
+        await add_channel(int(channel_id), int(days))
         await message.reply(f"Канал {channel_id} успішно додано.")
         logger.info(f"Канал {channel_id} додано користувачем {message.from_user.id}")
         log_action("add_channel")
     except ValueError:
         await message.reply("Неправильний формат команди. Використовуйте: /add_channel channel_id days")
 
-@dp.message(Command("remove_channel"))
-@admin_required
+@command("remove_channel")
 async def remove_channel_command(message: types.Message):
     try:
         _, channel_id = message.text.split()
-        remove_channel(int(channel_id))
+        await remove_channel(int(channel_id))
         await message.reply(f"Канал {channel_id} успішно видалено.")
         logger.info(f"Канал {channel_id} видалено користувачем {message.from_user.id}")
         log_action("remove_channel")
     except ValueError:
         await message.reply("Неправильний формат команди. Використовуйте: /remove_channel channel_id")
 
-@dp.message(Command("add_filter"))
-@admin_required
+@command("add_filter")
 async def add_filter_command(message: types.Message):
     try:
         _, channel_id, filter_type, *filter_value = message.text.split()
         filter_value = ' '.join(filter_value)
-        add_filter(int(channel_id), filter_type, filter_value)
+        await add_filter(int(channel_id), filter_type, filter_value)
         await message.reply(f"Фільтр {filter_type}: {filter_value} успішно додано до каналу {channel_id}.")
         logger.info(f"Фільтр {filter_type}: {filter_value} додано до каналу {channel_id} користувачем {message.from_user.id}")
         log_action("add_filter")
     except ValueError:
         await message.reply("Неправильний формат команди. Використовуйте: /add_filter channel_id filter_type filter_value")
 
-@dp.message(Command("remove_filter"))
-@admin_required
+@command("remove_filter")
 async def remove_filter_command(message: types.Message):
     try:
         _, filter_id = message.text.split()
-        remove_filter(int(filter_id))
+        await remove_filter(int(filter_id))
         await message.reply(f"Фільтр {filter_id} успішно видалено.")
         logger.info(f"Фільтр {filter_id} видалено користувачем {message.from_user.id}")
         log_action("remove_filter")
     except ValueError:
         await message.reply("Неправильний формат команди. Використовуйте: /remove_filter filter_id")
 
-@dp.message(Command("list_filters"))
-@admin_required
+@command("list_filters")
 async def list_filters_command(message: types.Message):
     filters = get_filters()
     if filters:
-        filter_list = "\n".join([f"ID: {f[0]}, Канал: {f[1]}, Тип: {f[2]}, Значення: {f[3]}" for f in filters])
-        await message.reply(f"Список фільтрів:\n{filter_list}")
+        lines = [f"ID: {f[0]}, Канал: {f[1]}, Тип: {f[2]}, Значення: {f[3]}" for f in filters]
+        for chunk in split_text(lines, header="Список фільтрів:"):
+            await message.reply(chunk)
     else:
         await message.reply("Список фільтрів порожній.")
     log_action("list_filters")
 
-@dp.message(Command("set_admin"))
-@superadmin_required
+# Імпорт і експорт каналів та фільтрів
+# Файл спершу повністю перевіряється; якщо є хоч одна помилка, нічого не
+# змінюється, інакше всі рядки записуються одним executemany в одній транзакції
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+IMPORT_MAX_ERRORS = 20
+FILTER_TYPES = ('tag', 'word', 'phrase', 'combination')
+CHANNEL_FIELDS = ('channel_id', 'expiry_date')
+FILTER_FIELDS = ('id', 'channel_id', 'filter_type', 'filter_value')
+
+def parse_table(data, filename=""):
+    """Розбирає CSV із заголовком або JSON-список об'єктів у список словників."""
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json') or text.lstrip().startswith('['):
+        rows = json.loads(text)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("JSON має бути списком об'єктів")
+        return rows
+    return list(csv.DictReader(io.StringIO(text)))
+
+def export_table(fields, rows, fmt='csv'):
+    if fmt == 'json':
+        return json.dumps([dict(zip(fields, row)) for row in rows], ensure_ascii=False, indent=1).encode('utf-8')
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    writer.writerows(rows)
+    # BOM, щоб Excel коректно відкрив кирилицю
+    return buf.getvalue().encode('utf-8-sig')
+
+def _row_error(number, error):
+    if isinstance(error, KeyError):
+        return f"Рядок {number}: відсутнє поле {error.args[0]}"
+    return f"Рядок {number}: {error}"
+
+def validate_channels(rows):
+    """Повертає (channel_id, expiry_date) для вставки і список помилок.
+
+    Кожен рядок містить channel_id і expiry_date (ISO) або days.
+    """
+    valid, errors, seen = [], [], set()
+    now = datetime.now()
+    for number, row in enumerate(rows, 1):
+        try:
+            channel_id = int(row['channel_id'])
+            if row.get('expiry_date'):
+                expiry = datetime.fromisoformat(str(row['expiry_date']))
+            elif row.get('days') not in (None, ''):
+                expiry = now + timedelta(days=int(row['days']))
+            else:
+                raise ValueError("потрібне поле expiry_date або days")
+            if expiry <= now:
+                raise ValueError(f"термін дії каналу {channel_id} уже минув")
+            if channel_id in seen:
+                raise ValueError(f"канал {channel_id} повторюється")
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(_row_error(number, e))
+            continue
+        seen.add(channel_id)
+        valid.append((channel_id, expiry.isoformat()))
+    return valid, errors
+
+def validate_filters(rows, channels, existing=()):
+    """Повертає (channel_id, filter_type, filter_value) для вставки, помилки та кількість дублікатів.
+
+    Дублікати (у файлі або серед existing) пропускаються, тож повторний
+    імпорт того самого файлу нічого не змінює.
+    """
+    valid, errors, seen = [], [], set(existing)
+    skipped = 0
+    for number, row in enumerate(rows, 1):
+        try:
+            channel_id = int(row['channel_id'])
+            filter_type = str(row['filter_type']).strip()
+            filter_value = str(row['filter_value']).strip()
+            if filter_type not in FILTER_TYPES:
+                raise ValueError(f"невідомий тип фільтра {filter_type!r}")
+            if not filter_value:
+                raise ValueError("порожнє значення фільтра")
+            if channel_id not in channels:
+                raise ValueError(f"канал {channel_id} не додано")
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(_row_error(number, e))
+            continue
+        key = (channel_id, filter_type, filter_value)
+        if key in seen:
+            skipped += 1
+            continue
+        seen.add(key)
+        valid.append(key)
+    return valid, errors, skipped
+
+def _import_channels(conn, rows, replace):
+    stale = []
+    if replace:
+        keep = {channel_id for channel_id, _ in rows}
+        stale = [(channel_id,) for (channel_id,) in conn.execute("SELECT channel_id FROM channels")
+                 if channel_id not in keep]
+        conn.executemany(DELETE_CHANNEL_FILTERS_QUERY, stale)
+        conn.executemany(DELETE_CHANNEL_QUERY, stale)
+    conn.executemany("INSERT INTO channels (channel_id, expiry_date) VALUES (?, ?) "
+                     "ON CONFLICT(channel_id) DO UPDATE SET expiry_date = excluded.expiry_date", rows)
+    return len(stale)
+
+def _import_filters(conn, rows, replace):
+    if replace:
+        conn.execute("DELETE FROM filters")
+    conn.executemany("INSERT INTO filters (channel_id, filter_type, filter_value) VALUES (?, ?, ?)", rows)
+
+async def import_channels(rows, replace=False):
+    """Додає або оновлює канали однією транзакцією; з replace видаляє відсутні у файлі."""
+    previous = get_channels()
+    removed = await db.run(_import_channels, rows, replace)
+    await config_changed()
+    reschedule_expiries(previous)
+    return removed
+
+async def import_filters(rows, replace=False):
+    """Додає фільтри однією транзакцією; з replace спершу видаляє всі наявні."""
+    await db.run(_import_filters, rows, replace)
+    await config_changed()
+
+async def download_table(document):
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        raise ValueError(f"файл більший за {IMPORT_MAX_BYTES // (1024 * 1024)} МБ")
+    buf = await bot.download(document, destination=io.BytesIO())
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, parse_table, buf.getvalue(), document.file_name or "")
+
+async def _reply_errors(message, errors):
+    lines = errors[:IMPORT_MAX_ERRORS]
+    if len(errors) > IMPORT_MAX_ERRORS:
+        lines.append(f"… і ще {len(errors) - IMPORT_MAX_ERRORS} помилок")
+    for chunk in split_text(lines, header="Імпорт скасовано, нічого не змінено. Помилки:"):
+        await message.reply(chunk)
+
+async def _import_source(message, usage):
+    """Повертає (рядки файлу, replace) або None, якщо вже відповіли про помилку."""
+    args = message.text.split()[1:]
+    document = message.reply_to_message.document if message.reply_to_message else None
+    if args not in ([], ['replace']) or document is None:
+        await message.reply(f"Відповідайте командою {usage} на повідомлення з файлом CSV або JSON.")
+        return None
+    try:
+        rows = await download_table(document)
+    except ValueError as e:
+        await message.reply(f"Не вдалося прочитати файл: {str(e)}")
+        return None
+    return rows, bool(args)
+
+@command("import_channels")
+async def import_channels_command(message: types.Message):
+    source = await _import_source(message, "/import_channels [replace]")
+    if source is None:
+        return
+    rows, replace = source
+    loop = asyncio.get_running_loop()
+    valid, errors = await loop.run_in_executor(None, validate_channels, rows)
+    if errors:
+        await _reply_errors(message, errors)
+        return
+    started = time.perf_counter()
+    removed = await import_channels(valid, replace)
+    await message.reply(f"Імпортовано каналів: {len(valid)}, видалено: {removed} "
+                        f"({time.perf_counter() - started:.2f} с).")
+    logger.info(f"Імпортовано {len(valid)} каналів (replace={replace}) користувачем {message.from_user.id}")
+    log_action("import_channels")
+
+@command("import_filters")
+async def import_filters_command(message: types.Message):
+    source = await _import_source(message, "/import_filters [replace]")
+    if source is None:
+        return
+    rows, replace = source
+    existing = () if replace else {(f[1], f[2], f[3]) for f in get_filters()}
+    loop = asyncio.get_running_loop()
+    valid, errors, skipped = await loop.run_in_executor(None, validate_filters, rows, get_channels(), existing)
+    if errors:
+        await _reply_errors(message, errors)
+        return
+    started = time.perf_counter()
+    await import_filters(valid, replace)
+    await message.reply(f"Імпортовано фільтрів: {len(valid)}, пропущено дублікатів: {skipped} "
+                        f"({time.perf_counter() - started:.2f} с).")
+    logger.info(f"Імпортовано {len(valid)} фільтрів (replace={replace}) користувачем {message.from_user.id}")
+    log_action("import_filters")
+
+async def _export(message, name, fields, rows):
+    args = message.text.split()[1:]
+    fmt = args[0].lower() if args else 'csv'
+    if fmt not in ('csv', 'json') or len(args) > 1:
+        await message.reply(f"Неправильний формат команди. Використовуйте: /export_{name} [csv|json]")
+        return
+    data = export_table(fields, rows, fmt)
+    filename = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    await message.reply_document(types.BufferedInputFile(data, filename=filename), caption=f"Записів: {len(rows)}")
+    log_action(f"export_{name}")
+
+@command("export_channels")
+async def export_channels_command(message: types.Message):
+    rows = [(channel_id, info['expiry_date']) for channel_id, info in get_channels().items()]
+    await _export(message, "channels", CHANNEL_FIELDS, rows)
+
+@command("export_filters")
+async def export_filters_command(message: types.Message):
+    await _export(message, "filters", FILTER_FIELDS, list(get_filters()))
+
+@command("set_admin", access='superadmin')
 async def set_admin_command(message: types.Message):
     try:
         _, user_id, role = message.text.split()
-        add_admin(int(user_id), role)
+        await add_admin(int(user_id), role)
         await message.reply(f"Адміністратор {user_id} з роллю {role} успішно додано.")
         logger.info(f"Додано нового адміністратора {user_id} з роллю {role}")
         log_action("set_admin")
     except ValueError:
         await message.reply("Неправильний формат команди. Використовуйте: /set_admin user_id role")
 
-@dp.message(Command("backup"))
-@superadmin_required
+# Резервне копіювання
+# Копіюється лише БД (без .env і логів) через online backup API SQLite:
+# копія узгоджена, а бот тим часом продовжує читати й писати
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", 1024))  # сторінок за один крок копіювання
+REQUIRED_TABLES = {'channels', 'filters', 'admins', 'main_channels', 'spam_settings', 'analytics'}
+# Робочий стан поточного запуску, а не дані: під час відновлення залишаємо поточний
+_OUTBOX_COLUMNS = "id, chat_id, from_chat_id, message_ids, status, attempts, next_attempt_at, last_error, created_at"
+_LEASE_COLUMNS = "name, owner, expires_at"
+
+def backup_database(source_path=DB_FILE, pages=BACKUP_PAGES):
+    """Знімає копію БД кроками по pages сторінок і стискає її; повертає шлях до .db.gz.
+
+    Виконується поза циклом подій із власним з'єднанням, тож потік БД бота
+    не блокується.
+    """
+    fd, raw_path = tempfile.mkstemp(prefix="bot-backup-", suffix=".db")
+    os.close(fd)
+    fd, gz_path = tempfile.mkstemp(prefix="bot-backup-", suffix=".db.gz")
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            source = sqlite3.connect(source_path)
+            target = sqlite3.connect(raw_path)
+            try:
+                source.backup(target, pages=pages, sleep=0)
+            finally:
+                target.close()
+                source.close()
+            with open(raw_path, 'rb') as src, gzip.open(raw, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+    except BaseException:
+        os.remove(gz_path)
+        raise
+    finally:
+        os.remove(raw_path)
+    return gz_path
+
+def prepare_snapshot(upload_path, page_size):
+    """Перевіряє завантажену копію (.db або .db.gz); повертає шлях до готового файлу БД.
+
+    Кидає ValueError, якщо файл не є цілою БД бота підтримуваної версії.
+    """
+    with open(upload_path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    path = upload_path
+    if compressed:
+        path = upload_path + ".db"
+        with gzip.open(upload_path, 'rb') as src, open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+            if result != 'ok':
+                raise ValueError(f"перевірка цілісності не пройдена: {result}")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise ValueError(f"версія схеми {version} новіша за підтримувану {SCHEMA_VERSION}")
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            missing = REQUIRED_TABLES - tables
+            if missing:
+                raise ValueError(f"відсутні таблиці: {', '.join(sorted(missing))}")
+            if conn.execute("PRAGMA page_size").fetchone()[0] != page_size:
+                # Копіювати в БД у режимі WAL можна лише з тим самим розміром сторінки
+                conn.execute("PRAGMA journal_mode=DELETE")
+                conn.execute(f"PRAGMA page_size = {int(page_size)}")
+                conn.execute("VACUUM")
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        if path != upload_path:
+            os.remove(path)
+        raise ValueError(f"файл не є базою даних SQLite: {e}")
+    except BaseException:
+        if path != upload_path:
+            os.remove(path)
+        raise
+    return path
+
+def _restore_from(conn, snapshot_path):
+    outbox_rows = conn.execute(f"SELECT {_OUTBOX_COLUMNS} FROM outbox").fetchall()
+    lease_rows = conn.execute(f"SELECT {_LEASE_COLUMNS} FROM leases").fetchall()
+    live_version = conn.execute(CONFIG_VERSION_QUERY).fetchone()[0]
+    snapshot = sqlite3.connect(snapshot_path)
+    try:
+        snapshot.backup(conn, pages=BACKUP_PAGES, sleep=0)
+    finally:
+        snapshot.close()
+    _migrate(conn)
+    conn.execute("DELETE FROM outbox")
+    conn.executemany(f"INSERT INTO outbox ({_OUTBOX_COLUMNS}) VALUES ({', '.join('?' * 9)})", outbox_rows)
+    conn.execute("DELETE FROM leases")
+    conn.executemany(f"INSERT INTO leases ({_LEASE_COLUMNS}) VALUES (?, ?, ?)", lease_rows)
+    # Версія з копії може бути старішою за ту, що вже бачили інші процеси;
+    # config_changed() далі додасть 1, тож вона гарантовано зміниться для всіх
+    conn.execute("UPDATE meta SET value = max(value, ?) WHERE key = 'config_version'", (live_version,))
+
+async def restore_database(snapshot_path):
+    """Підміняє вміст робочої БД копією без перезапуску бота.
+
+    Копія записується в живе з'єднання в потоці БД, після чого схема
+    доводиться до поточної версії, конфігурація перечитується (і в інших
+    процесах кластера), а задачі закінчення терміну дії переплановуються.
+    """
+    previous = get_channels()
+    await flush_analytics()
+    await db.run(_restore_from, snapshot_path)
+    await config_changed()
+    reschedule_expiries(previous)
+    await check_expired_channels()
+
+@command("backup", access='superadmin')
 async def backup_command(message: types.Message):
-    return
+    path = None
     try:
-        backup_filename = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-        shutil.make_archive(backup_filename[:-4], 'zip', root_dir='.', base_dir='.')
-        
-        await message.reply_document(FSInputFile(backup_filename))
-        
-        os.remove(backup_filename)
-        
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(None, backup_database)
+        backup_filename = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db.gz"
+        await message.reply_document(FSInputFile(path, filename=backup_filename))
+
         logger.info(f"Створено резервну копію користувачем {message.from_user.id}")
         log_action("backup")
     except Exception as e:
         await message.reply(f"Помилка при створенні резервної копії: {str(e)}")
         logger.error(f"Помилка при створенні резервної копії: {str(e)}")
+    finally:
+        if path:
+            os.remove(path)
 
-@dp.message(Command("restore"))
-@superadmin_required
+@command("restore", access='superadmin')
 async def restore_command(message: types.Message):
-    return
     if not message.reply_to_message or not message.reply_to_message.document:
         await message.reply("Будь ласка, відповідайте на повідомлення з файлом резервної копії.")
         return
 
+    fd, upload_path = tempfile.mkstemp(prefix="bot-restore-")
+    os.close(fd)
+    snapshot_path = None
     try:
-        file = await bot.get_file(message.reply_to_message.document.file_id)
-        file_path = file.file_path
-        await bot.download_file(file_path, "restore.zip")
-
-        shutil.unpack_archive("restore.zip", ".")
-
-        os.remove("restore.zip")
-
-        await message.reply("Дані успішно відновлено з резервної копії.")
+        await bot.download(message.reply_to_message.document, destination=upload_path)
+        loop = asyncio.get_running_loop()
+        page_size = (await execute_db("PRAGMA page_size"))[0][0]
+        snapshot_path = await loop.run_in_executor(None, prepare_snapshot, upload_path, page_size)
+
+        # Поточний стан зберігаємо поруч із БД на випадок, якщо відновили не ту копію
+        safety_path = await loop.run_in_executor(None, backup_database)
+        shutil.move(safety_path, f"{DB_FILE}.pre-restore.db.gz")
+        await restore_database(snapshot_path)
+
+        await message.reply(f"Дані успішно відновлено з резервної копії. "
+                            f"Попередній стан збережено у {DB_FILE}.pre-restore.db.gz.")
         logger.info(f"Відновлено дані з резервної копії користувачем {message.from_user.id}")
         log_action("restore")
+    except ValueError as e:
+        await message.reply(f"Файл не підходить для відновлення: {str(e)}")
+        logger.warning(f"Відхилено резервну копію: {str(e)}")
     except Exception as e:
         await message.reply(f"Помилка при відновленні даних: {str(e)}")
         logger.error(f"Помилка при відновленні даних: {str(e)}")
+    finally:
+        for path in {upload_path, snapshot_path} - {None}:
+            os.remove(path)
 
-@dp.message(Command("add_main_channel"))
-@superadmin_required
+@command("add_main_channel", access='superadmin')
 async def add_main_channel_command(message: types.Message):
     try:
         _, channel_id = message.text.split()
-        add_main_channel(int(channel_id))
+        await add_main_channel(int(channel_id))
         await message.reply(f"Основний канал {channel_id} успішно додано.")
         logger.info(f"Додано основний канал {channel_id} користувачем {message.from_user.id}")
         log_action("add_main_channel")
     except ValueError:
         await message.reply("Неправильний формат команди. Використовуйте: /add_main_channel channel_id")
 
-@dp.message(Command("remove_main_channel"))
-@superadmin_required
+@command("remove_main_channel", access='superadmin')
 async def remove_main_channel_command(message: types.Message):
     try:
         _, channel_id = message.text.split()
-        remove_main_channel(int(channel_id))
+        await remove_main_channel(int(channel_id))
         await message.reply(f"Основний канал {channel_id} успішно видалено.")
         logger.info(f"Видалено основний канал {channel_id} користувачем {message.from_user.id}")
         log_action("remove_main_channel")
     except ValueError:
         await message.reply("Неправильний формат команди. Використовуйте: /remove_main_channel channel_id")
 
-@dp.message(Command("list_main_channels"))
-@admin_required
+@command("list_main_channels")
 async def list_main_channels_command(message: types.Message):
     main_channels = get_main_channels()
     if main_channels:
@@ -411,68 +1841,276 @@ async def list_main_channels_command(message: types.Message):
         await message.reply("Список основних каналів порожній.")
     log_action("list_main_channels")
 
-@dp.message(Command("set_spam_settings"))
-@superadmin_required
+@command("set_spam_settings", access='superadmin')
 async def set_spam_settings_command(message: types.Message):
     try:
         _, max_messages, time_window = message.text.split()
-        set_spam_settings(int(max_messages), int(time_window))
+        await set_spam_settings(int(max_messages), int(time_window))
         await message.reply(f"Налаштування захисту від спаму оновлено: {max_messages} повідомлень за {time_window} секунд.")
         logger.info(f"Оновлено налаштування захисту від спаму користувачем {message.from_user.id}")
         log_action("set_spam_settings")
     except ValueError:
         await message.reply("Неправильний формат команди. Використовуйте: /set_spam_settings max_messages time_window")
 
-@dp.message(Command("get_spam_settings"))
-@admin_required
+@command("get_spam_settings")
 async def get_spam_settings_command(message: types.Message):
     spam_settings = get_spam_settings()
     if spam_settings:
-        await message.reply(f"Поточні налаштування захисту від спаму: {spam_settings[1]} повідомлень за {spam_settings[2]} секунд.")
+        stats = spam_detector.stats()
+        await message.reply(f"Поточні налаштування захисту від спаму: {spam_settings[1]} повідомлень за {spam_settings[2]} секунд.\n"
+                            f"Відстежується користувачів: {stats['tracked_users']}, пам'ять ≈ {stats['memory_bytes'] // 1024} КБ, "
+                            f"заблоковано повідомлень: {stats['blocked']}.")
     else:
         await message.reply("Налаштування захисту від спаму не встановлені.")
     log_action("get_spam_settings")
 
-@dp.message(Command("get_logs"))
-@superadmin_required
+# Витяг з логів
+LOG_EXTRACT_LINES = 1000
+_LOG_RECORD_START = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} ")
+_LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+_RELATIVE_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+
+def _parse_log_time(value, end=False):
+    """Приймає ISO-дату/час або відносний час (30m, 2h, 7d тому)."""
+    match = re.fullmatch(r"(\d+)([mhd])", value)
+    if match:
+        moment = datetime.now() - timedelta(**{_RELATIVE_UNITS[match.group(2)]: int(match.group(1))})
+    else:
+        moment = datetime.fromisoformat(value)
+        if end and len(value) == 10:
+            # until=2024-01-31 включає весь день
+            moment += timedelta(days=1)
+    return moment.strftime(_LOG_TIME_FORMAT)
+
+def parse_log_options(args):
+    """Розбирає аргументи /get_logs виду key=value; кидає ValueError для невідомих."""
+    options = {'lines': None, 'since': None, 'until': None, 'level': logging.NOTSET}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key == 'lines':
+            options['lines'] = int(value)
+            if options['lines'] <= 0:
+                raise ValueError(arg)
+        elif key in ('since', 'until'):
+            options[key] = _parse_log_time(value, end=key == 'until')
+        elif key == 'level':
+            level = logging.getLevelName(value.upper())
+            if not isinstance(level, int):
+                raise ValueError(arg)
+            options['level'] = level
+        else:
+            raise ValueError(arg)
+    if options['lines'] is None and options['since'] is None and options['until'] is None:
+        options['lines'] = LOG_EXTRACT_LINES
+    return options
+
+def _log_sources():
+    """Імена файлів логу, з яких береться витяг.
+
+    У кластері (run_cluster) кожен шард пише власний bot.<shard>.log, а
+    супервізор — bot.log, тож лідер читає їх усі, а не лише свій файл.
+    """
+    own = file_handler.baseFilename
+    if SHARD_COUNT == 1:
+        return [own]
+    root, ext = os.path.splitext(own)
+    suffix = f".{SHARD_INDEX}"
+    if root.endswith(suffix):
+        root = root[:-len(suffix)]
+    return [root + ext] + [f"{root}.{index}{ext}" for index in range(SHARD_COUNT)]
+
+def _log_files(base):
+    """Файл логу base і його стиснені архіви, від найновішого до найстаршого."""
+    archives = sorted(glob.glob(glob.escape(base) + ".*.gz"), key=os.path.getmtime, reverse=True)
+    return [base] + archives if os.path.exists(base) else archives
+
+def _read_log_records(path):
+    # Рядки без мітки часу (traceback тощо) належать до попереднього запису
+    opener = gzip.open if path.endswith(".gz") else open
+    record = None
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if _LOG_RECORD_START.match(line):
+                if record is not None:
+                    yield record
+                record = [line]
+            elif record is not None:
+                record.append(line)
+    if record is not None:
+        yield record
+
+def _matching_log_records(path, since, until, level):
+    for record in _read_log_records(path):
+        timestamp = record[0][:19]
+        if since and timestamp < since:
+            continue
+        if until and timestamp >= until:
+            break
+        if level:
+            parts = record[0].split(' ', 4)
+            levelno = logging.getLevelName(parts[3]) if len(parts) > 3 else None
+            if isinstance(levelno, int) and levelno < level:
+                continue
+        yield record
+
+def _select_log_files(base, lines, since, until, level):
+    """Файли з родини base, потрібні для витягу (від найстаршого), і кількість записів у них для lines."""
+    files = []
+    found = 0
+    for path in _log_files(base):
+        if since and path.endswith(".gz") and datetime.fromtimestamp(os.path.getmtime(path)).strftime(_LOG_TIME_FORMAT) < since:
+            # Архів закрито раніше за since — у ньому та старших немає потрібних записів
+            break
+        files.append(path)
+        if lines:
+            found += sum(1 for _ in _matching_log_records(path, since, until, level))
+            if found >= lines:
+                break
+    return files[::-1], found
+
+def _log_stream(files, since, until, level):
+    for path in files:
+        yield from _matching_log_records(path, since, until, level)
+
+def extract_logs(lines=None, since=None, until=None, level=logging.NOTSET):
+    """Записує відібрані записи логу в тимчасовий .gz-файл; повертає (шлях, кількість).
+
+    Читає файли потоково: для lines спершу з кінця рахує, скільки архівів
+    потрібно, і лише потім пише останні lines записів у хронологічному порядку.
+    Логи кількох процесів кластера зливаються за міткою часу.
+    """
+    streams = []
+    found = 0
+    for base in _log_sources():
+        files, count = _select_log_files(base, lines, since, until, level)
+        streams.append(_log_stream(files, since, until, level))
+        found += count
+    skip = found - lines if lines and found > lines else 0
+    written = 0
+    fd, out_path = tempfile.mkstemp(prefix="bot-logs-", suffix=".log.gz")
+    with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as out:
+        # Мітка часу з мілісекундами — перші 23 символи запису
+        for record in heapq.merge(*streams, key=lambda record: record[0][:23]):
+            if skip:
+                skip -= 1
+                continue
+            out.writelines(record)
+            written += 1
+    return out_path, written
+
+@command("get_logs", access='superadmin')
 async def get_logs_command(message: types.Message):
     try:
-        await message.reply_document(FSInputFile(log_filename))
-        logger.info(f"Відправлено файл логів користувачу {message.from_user.id}")
+        options = parse_log_options(message.text.split()[1:])
+    except ValueError:
+        await message.reply("Неправильний формат команди. Використовуйте: /get_logs [lines=N] [since=T] [until=T] [level=L]\n"
+                            "T — дата/час ISO (2024-01-31, 2024-01-31T12:00) або відносно зараз (30m, 2h, 7d).")
+        return
+    path = None
+    try:
+        loop = asyncio.get_running_loop()
+        path, count = await loop.run_in_executor(None, lambda: extract_logs(**options))
+        if not count:
+            await message.reply("За вказаними умовами записів у логах не знайдено.")
+            return
+        filename = f"bot-logs-{datetime.now().strftime('%Y%m%d-%H%M%S')}.log.gz"
+        await message.reply_document(FSInputFile(path, filename=filename), caption=f"Записів: {count}")
+        logger.info(f"Відправлено витяг з логів ({count} записів) користувачу {message.from_user.id}")
         log_action("get_logs")
     except Exception as e:
         await message.reply(f"Помилка при відправленні файлу логів: {str(e)}")
         logger.error(f"Помилка при відправленні файлу логів: {str(e)}")
+    finally:
+        if path:
+            os.remove(path)
+
+def format_stats():
+    """Короткий текстовий звіт за зібраними метриками."""
+    def ms(value):
+        return f"{value * 1000:.1f} мс"
+
+    lines = [f"Аптайм: {timedelta(seconds=int(time.time() - metrics.started))}", "", "Хендлери:"]
+    for labels, h in sorted(metrics.histograms_of('handler_seconds').items(), key=lambda item: -item[1].count):
+        lines.append(f"  {dict(labels)['handler']}: {h.count}, сер. {ms(h.sum / h.count)}, p99 ≤ {ms(h.quantile(0.99))}")
+    lines += ["", "База даних:"]
+    for labels, h in sorted(metrics.histograms_of('db_seconds').items(), key=lambda item: -item[1].sum)[:10]:
+        lines.append(f"  {dict(labels)['query']}: {h.count}, сер. {ms(h.sum / h.count)}")
+    for labels, h in metrics.histograms_of('filter_match_seconds').items():
+        lines += ["", f"Фільтри: {h.count} перевірок, сер. {ms(h.sum / h.count)}, p99 ≤ {ms(h.quantile(0.99))}"]
+    lines.append(f"Пересилання: успішно {metrics.total('forwards_total', result='ok')}, "
+                 f"помилок {metrics.total('forwards_total', result='error')}, "
+                 f"retry_after {metrics.total('retry_after_total')}")
+    lines.append(f"Черга розсилки: {fanout.queued} в очікуванні, {fanout.in_flight} в процесі")
+    queue_stats = outbox.stats()
+    lines.append(f"Outbox: {queue_stats['pending']} в черзі, {queue_stats['forwarding']} пересилаються, "
+                 f"{queue_stats['dead']} у dead-letter (/dead_letters)")
+    lag = metrics.histograms_of('event_loop_lag_seconds').get(())
+    if lag:
+        lines.append(f"Затримка циклу подій: остання {ms(metrics.last_loop_lag)}, p99 ≤ {ms(lag.quantile(0.99))}")
+    return "\n".join(lines)
+
+@command("stats", access='superadmin')
+async def stats_command(message: types.Message):
+    await message.reply(format_stats())
+    log_action("stats")
+
+@command("dead_letters", access='superadmin')
+async def dead_letters_command(message: types.Message):
+    rows = await outbox.dead_letters()
+    if not rows:
+        await message.reply("Dead-letter порожній.")
+        return
+    lines = [f"#{row_id}: канал {chat_id}, повідомлення {message_ids} з {from_chat_id}, "
+             f"спроб {attempts}: {last_error}" for row_id, chat_id, from_chat_id, message_ids, attempts, last_error in rows]
+    header = (f"Dead-letter: {outbox.stats()['dead']} записів, останні {len(rows)}.\n"
+              f"Повторити: /retry_dead [all | ID ...], очистити: /purge_dead [днів]")
+    for chunk in split_text(lines, header=header):
+        await message.reply(chunk)
+    log_action("dead_letters")
+
+@command("retry_dead", access='superadmin')
+async def retry_dead_command(message: types.Message):
+    args = message.text.split()[1:]
+    try:
+        ids = None if args in ([], ['all']) else [int(arg) for arg in args]
+    except ValueError:
+        await message.reply("Неправильний формат команди. Використовуйте: /retry_dead [all | ID ...]")
+        return
+    count = await outbox.retry_dead(ids)
+    await message.reply(f"Повернуто в чергу: {count}.")
+    logger.info(f"Повернуто в чергу {count} dead-letter записів користувачем {message.from_user.id}")
+    log_action("retry_dead")
+
+@command("purge_dead", access='superadmin')
+async def purge_dead_command(message: types.Message):
+    args = message.text.split()[1:]
+    try:
+        days = float(args[0]) if args else 0
+        if len(args) > 1 or days < 0:
+            raise ValueError(days)
+    except ValueError:
+        await message.reply("Неправильний формат команди. Використовуйте: /purge_dead [днів] (за замовчуванням усі)")
+        return
+    count = await outbox.purge_dead(time.time() - days * DAY)
+    await message.reply(f"Видалено dead-letter записів: {count}.")
+    logger.info(f"Видалено {count} dead-letter записів користувачем {message.from_user.id}")
+    log_action("purge_dead")
 
-@dp.message(Command("analytics"))
-@admin_required
+@command("analytics")
 async def analytics_command(message: types.Message):
+    # Кнопка «📈 Аналітика» викликає цей хендлер без аргументів
+    args = message.text.split()[1:] if message.text.startswith('/') else []
     try:
-        data = get_analytics()
-        
-        # Створення графіку
-        plt.figure(figsize=(10, 6))
-        actions = list(set([row[1] for row in data]))
-        for action in actions:
-            action_data = [row for row in data if row[1] == action]
-            dates = [datetime.strptime(row[0], '%Y-%m-%d').date() for row in action_data]
-            counts = [row[2] for row in action_data]
-            plt.plot(dates, counts, label=action)
-
-        plt.title("Аналітика використання бота")
-        plt.xlabel("Дата")
-        plt.ylabel("Кількість дій")
-        plt.legend()
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-
-        # Зберігаємо графік у буфер
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
+        days = int(args[0]) if args else 30
+    except ValueError:
+        await message.reply("Неправильний формат команди. Використовуйте: /analytics [days]")
+        return
+    days = max(1, min(days, ANALYTICS_MAX_DAYS))
+    try:
+        png, caption = await get_analytics_chart(days)
 
         # Відправляємо графік
-        await message.reply_photo(types.BufferedInputFile(buf.getvalue(), filename="analytics.png"))
+        await message.reply_photo(types.BufferedInputFile(png, filename="analytics.png"), caption=caption)
         
         logger.info(f"Відправлено аналітику користувачу {message.from_user.id}")
         log_action("analytics")
@@ -480,94 +2118,806 @@ async def analytics_command(message: types.Message):
         await message.reply(f"Помилка при створенні аналітики: {str(e)}")
         logger.error(f"Помилка при створенні аналітики: {str(e)}")
 
+# Буферизація альбомів: частини однієї media group збираються, доки не
+# настане пауза ALBUM_WAIT, і пересилаються одним викликом forward_messages.
+# До цього моменту частини є лише в пам'яті (в outbox вони потрапляють після
+# паузи): при штатній зупинці main() дочікується їх, але аварійне завершення
+# процесу в межах ALBUM_WAIT після останньої частини втрачає такий альбом.
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", 1.0))
+_albums = {}
+_album_tasks = set()
+
 @dp.channel_post()
 async def forward_message(message: types.Message):
     """Пересилає повідомлення у відповідні канали на основі фільтрів."""
 
-    main_channels = get_main_channels()
-    
-    if str(message.chat.id) not in main_channels:
+    config = get_config()
+
+    if str(message.chat.id) not in config.main_channels:
         return  # Ігноруємо повідомлення, які не з основних каналів
 
-    user_id = message.from_user.id if message.from_user else None
+    album_key = (message.chat.id, message.media_group_id) if message.media_group_id else None
+    if album_key in _albums:
+        _albums[album_key].append(message)
+        return
+
+    sender = spam_sender(message)
     
-    if user_id and is_spam(user_id):
+    if sender is not None and is_spam(sender):
         #await message.reply("Ви відправляєте повідомлення занадто часто. Будь ласка, спробуйте пізніше.")
-        logger.warning(f"Spam detected from user {user_id}")
+        logger.warning(f"Spam detected from sender {sender}")
+        notify_admins(f"Пост {message.message_id} з каналу {message.chat.id} не переслано: "
+                      f"автор {message.author_signature or sender} перевищив ліміт повідомлень.",
+                      key=f"spam:{sender}")
         return
 
-    text = message.text or message.caption or ""
-    current_time = datetime.now()
+    if album_key:
+        _albums[album_key] = [message]
+        task = asyncio.create_task(flush_album(album_key))
+        _album_tasks.add(task)
+        task.add_done_callback(_album_tasks.discard)
+        return
 
-    channels = get_channels()
-    filters = get_filters()
+    await route_messages([message])
+
+async def flush_album(album_key):
+    """Чекає, поки альбом перестане поповнюватися, і маршрутизує його цілком."""
+    parts = _albums[album_key]
+    size = 0
+    while size != len(parts):
+        size = len(parts)
+        await asyncio.sleep(ALBUM_WAIT)
+    del _albums[album_key]
+    parts.sort(key=lambda part: part.message_id)
+    try:
+        await route_messages(parts)
+    except Exception as e:
+        chat_id, media_group_id = album_key
+        logger.error(f"Failed to route album {media_group_id} from chat {chat_id}: {e}")
+        notify_admins(f"Не вдалося обробити альбом {media_group_id} з каналу {chat_id}: {e}",
+                      key=f"album_error:{chat_id}")
+
+async def route_messages(messages):
+    """Підбирає канали за текстом (для альбому — за всіма підписами разом) і пересилає."""
+    config = get_config()
+    text = "\n".join(part for part in (m.text or m.caption for m in messages) if part)
+    hashtags = [tag for m in messages for tag in extract_hashtags(m)]
+
+    # Прострочені канали видаляються окремими задачами планувальника
+    started = time.perf_counter()
+    filter_ids = config.matcher.match_filters(text, hashtags)
+    matched_channels = config.matcher.channels_of(filter_ids)
+    metrics.observe('filter_match_seconds', time.perf_counter() - started)
+    targets = [channel_id for channel_id in config.channels if channel_id in matched_channels]
+    record_series('filter', filter_ids)
+    record_series('matched', targets)
+
+    if targets:
+        message_ids = [m.message_id for m in messages]
+        await outbox.enqueue(messages[0].chat.id, message_ids, targets)
+
+# Надійна черга пересилань
+# Кожне пересилання спершу записується в таблицю outbox і видаляється лише
+# після успішної відправки, тож після падіння процесу воно буде повторене
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 16))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_MAX_PENDING = int(os.getenv("OUTBOX_MAX_PENDING", 50000))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", 5))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", 3600))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 0.5))
+OUTBOX_STOP_TIMEOUT = float(os.getenv("OUTBOX_STOP_TIMEOUT", 10))
+
+# Помилки, які не зникнуть після повтору (бота видалено з каналу, повідомлення не існує)
+PERMANENT_FORWARD_ERRORS = (TelegramBadRequest, TelegramForbiddenError)
+
+class Outbox:
+    """Черга пересилань у SQLite з доставкою «хоча б один раз».
+
+    Диспетчер забирає записи, яким настав час, позначає їх як 'sending' і
+    передає пулу воркерів. Результати (успіх, повтор з експоненційною
+    затримкою, dead-letter) записуються в БД пакетами. Якщо в черзі
+    більше max_pending записів, enqueue чекає, доки вона не розвантажиться.
+
+    У кластері кожен процес доставляє лише записи свого шарда
+    (abs(chat_id) % shard_count == shard_index), тож ліміти на канал
+    дотримуються одним процесом, а лічильники черги періодично беруться з БД.
+    """
 
-    for channel_id, info in list(channels.items()):
-        if datetime.fromisoformat(info['expiry_date']) < current_time:
-            remove_channel(channel_id)
-            await notify_admins(f"Канал {channel_id} видалено через закінчення терміну дії.")
-            continue
+    def __init__(self, database, workers=OUTBOX_WORKERS, batch_size=OUTBOX_BATCH_SIZE,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, max_pending=OUTBOX_MAX_PENDING,
+                 shard_index=SHARD_INDEX, shard_count=SHARD_COUNT):
+        self.db = database
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.pending = 0
+        self.dead = 0
+        self.forwarding = 0  # пересилань, що чекають ліміту або виконуються у FanOut
+        self._refresh_at = 0.0
+        self._queue = asyncio.Queue(maxsize=workers * 2)
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Condition()
+        self._done = []
+        self._retry = []
+        self._failed = []
+        self._tasks = []
+
+    # Ingestion
+    async def enqueue(self, from_chat_id, message_ids, targets):
+        if self.pending >= self.max_pending:
+            metrics.inc('outbox_backpressure_total')
+            async with self._drained:
+                await self._drained.wait_for(lambda: self.pending < self.max_pending)
+        now = time.time()
+        ids = ",".join(str(message_id) for message_id in message_ids)
+        rows = [(chat_id, from_chat_id, ids, now, now) for chat_id in targets]
+        await self.db.run(_insert_outbox, rows)
+        self.pending += len(rows)
+        self._wakeup.set()
+
+    # Життєвий цикл
+    async def recover(self):
+        """Повертає в чергу записи, що залишилися 'sending' після зупинки або падіння."""
+        self.pending, self.dead = await self.db.run(_recover_outbox, self.shard_index, self.shard_count)
+        if self.pending:
+            logger.info(f"Outbox recovered {self.pending} pending forwards")
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=OUTBOX_STOP_TIMEOUT):
+        if not self._tasks:
+            return
+        dispatcher, workers = self._tasks[0], self._tasks[1:]
+        dispatcher.cancel()
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox stopped with {self._queue.qsize()} claimed forwards, they will be retried")
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._settle()
+        await self.db.run(_recover_outbox, self.shard_index, self.shard_count)
+
+    # Диспетчер і воркери
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            wanted = claimed = 0
+            try:
+                await self._settle()
+                if self.shard_count > 1 and time.monotonic() >= self._refresh_at:
+                    await self._refresh()
+                wanted = min(self._queue.maxsize - self._queue.qsize(), self.batch_size)
+                if wanted:
+                    rows = await self.db.run(_claim_outbox, time.time(), wanted, self.shard_index, self.shard_count)
+                    for row in rows:
+                        self._queue.put_nowait(row)
+                    claimed = len(rows)
+            except Exception as e:
+                logger.error(f"Outbox dispatcher error: {e}")
+            if not wanted or claimed < wanted:
+                # Чекаємо нових записів, звільнення воркерів або настання часу повтору
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _work(self):
+        while True:
+            row = await self._queue.get()
+            try:
+                await self._deliver(*row)
+            except Exception as e:
+                # Збій поза самим надсиланням (наприклад, БД заблокована іншим процесом):
+                # воркер має жити далі, а запис — повернутися в чергу, а не лишитися в 'sending'
+                row_id, chat_id, attempts = row[0], row[1], row[4] + 1
+                logger.error(f"Outbox worker error for channel {chat_id} (attempt {attempts}): {e}")
+                self._fail(row_id, chat_id, attempts, e)
+            finally:
+                self._queue.task_done()
+                self._wakeup.set()
+
+    async def _deliver(self, row_id, chat_id, from_chat_id, message_ids, attempts):
+        if chat_id not in get_channels() and not await self.db.execute(CHANNEL_EXISTS_QUERY, (chat_id,)):
+            # Канал видалили, поки пересилання чекало в черзі (знімок конфігурації
+            # іншого процесу кластера може відставати, тому перевіряємо саму БД)
+            self._done.append(row_id)
+            return
+        message_ids = [int(message_id) for message_id in message_ids.split(",")]
+        if len(message_ids) == 1:
+            call = lambda: bot.forward_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_ids[0])
+        else:
+            call = lambda: bot.forward_messages(chat_id=chat_id, from_chat_id=from_chat_id, message_ids=message_ids)
+        self.forwarding += 1
+        try:
+            await fanout.send(chat_id, call)
+        except Exception as e:
+            attempts += 1
+            metrics.inc('forwards_total', chat=chat_id, result='error')
+            logger.error(f"Error forwarding message to channel {chat_id} (attempt {attempts}): {e}")
+            self._fail(row_id, chat_id, attempts, e)
+            return
+        finally:
+            self.forwarding -= 1
+        self._done.append(row_id)
+        logger.info(f"Message forwarded to channel {chat_id}")
+        log_action("forward_message")
+        record_series('forwarded', (chat_id,))
+        metrics.inc('forwards_total', chat=chat_id, result='ok')
+
+    def _fail(self, row_id, chat_id, attempts, error):
+        """Планує повтор з експоненційною затримкою або переносить запис у dead-letter."""
+        if attempts >= self.max_attempts or isinstance(error, PERMANENT_FORWARD_ERRORS):
+            self._failed.append((attempts, str(error), row_id))
+            notify_admins(f"Не вдалося переслати повідомлення до каналу {chat_id} після {attempts} спроб: {error}",
+                          key=f"forward_error:{chat_id}")
+        else:
+            delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** (attempts - 1))
+            self._retry.append((attempts, time.time() + delay * random.uniform(0.8, 1.2), str(error), row_id))
+
+    async def _settle(self):
+        """Записує накопичені результати доставки однією транзакцією."""
+        if not (self._done or self._retry or self._failed):
+            return
+        done, retry, failed = self._done, self._retry, self._failed
+        self._done, self._retry, self._failed = [], [], []
+        try:
+            await self.db.run(_settle_outbox, done, retry, failed)
+        except Exception:
+            self._done += done
+            self._retry += retry
+            self._failed += failed
+            raise
+        self.pending -= len(done) + len(failed)
+        self.dead += len(failed)
+        async with self._drained:
+            self._drained.notify_all()
+
+    async def _refresh(self):
+        # Записи додає лідер, а доставляють усі процеси, тож власні підрахунки
+        # кожного процесу неповні — беремо загальні лічильники з БД
+        self.pending, self.dead = await self.db.run(_count_outbox)
+        self._refresh_at = time.monotonic() + OUTBOX_POLL_INTERVAL
+        async with self._drained:
+            self._drained.notify_all()
+
+    def stats(self):
+        return {'pending': self.pending, 'dead': self.dead, 'claimed': self._queue.qsize(),
+                'forwarding': self.forwarding}
+
+    # Dead-letter: записи, які вичерпали спроби, лишаються в БД до повтору або очищення
+    async def dead_letters(self, limit=20):
+        return await self.db.execute(DEAD_LETTERS_QUERY, (limit,))
+
+    async def retry_dead(self, ids=None):
+        """Повертає в чергу всі dead-letter записи (або лише ids) з обнуленими спробами."""
+        count = await self.db.run(_requeue_dead, time.time(), ids)
+        self.pending += count
+        self.dead -= count
+        self._wakeup.set()
+        return count
+
+    async def purge_dead(self, before):
+        """Видаляє dead-letter записи, створені раніше за before (час Unix)."""
+        count = await self.db.run(_purge_dead, before)
+        self.dead -= count
+        return count
+
+def _insert_outbox(conn, rows):
+    conn.executemany("INSERT INTO outbox (chat_id, from_chat_id, message_ids, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                     rows)
+
+def _count_outbox(conn):
+    pending = conn.execute(COUNT_OUTBOX_QUERY, ('pending',)).fetchone()[0]
+    dead = conn.execute(COUNT_OUTBOX_QUERY, ('dead',)).fetchone()[0]
+    return pending, dead
+
+def _recover_outbox(conn, shard_index=0, shard_count=1):
+    # Лише записи свого шарда: решту зараз можуть доставляти інші процеси
+    conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending' AND abs(chat_id) % ? = ?",
+                 (shard_count, shard_index))
+    return _count_outbox(conn)
+
+def _claim_outbox(conn, now, limit, shard_index=0, shard_count=1):
+    rows = conn.execute(CLAIM_OUTBOX_QUERY, (now, shard_count, shard_index, limit)).fetchall()
+    conn.executemany(MARK_SENDING_QUERY, [(row[0],) for row in rows])
+    return rows
+
+def _settle_outbox(conn, done, retry, failed):
+    conn.executemany(OUTBOX_DONE_QUERY, [(row_id,) for row_id in done])
+    conn.executemany(OUTBOX_RETRY_QUERY, retry)
+    conn.executemany(OUTBOX_DEAD_QUERY, failed)
+
+def _requeue_dead(conn, now, ids=None):
+    if ids is None:
+        return conn.execute(REQUEUE_DEAD_QUERY, (now,)).rowcount
+    return conn.executemany(REQUEUE_DEAD_ROW_QUERY, [(now, row_id) for row_id in ids]).rowcount
+
+def _purge_dead(conn, before):
+    return conn.execute(PURGE_DEAD_QUERY, (before,)).rowcount
+
+outbox = Outbox(db)
+
+metrics.gauge('outbox_pending', lambda: outbox.pending)
+metrics.gauge('outbox_dead', lambda: outbox.dead)
+
+# Сповіщення адміністраторів
+NOTIFY_DIGEST_INTERVAL = int(os.getenv("NOTIFY_DIGEST_INTERVAL", 300))
+NOTIFY_SEND_RATE = float(os.getenv("NOTIFY_SEND_RATE", 5))
+NOTIFY_MAX_DEFER = float(os.getenv("NOTIFY_MAX_DEFER", 30))
+MAX_MESSAGE_LENGTH = 4096
+
+class AdminNotifier:
+    """Розсилає сповіщення адміністраторам без дублікатів.
+
+    Перша подія з певним ключем надсилається одразу; повтори протягом
+    NOTIFY_DIGEST_INTERVAL лише підраховуються й потрапляють у періодичний
+    дайджест. Надсилання йде паралельно з власним лімітом швидкості і
+    поступається пересиланню: поки outbox має пересилання у FanOut,
+    сповіщення чекають (але не довше за NOTIFY_MAX_DEFER). Власні
+    сповіщення в цьому лічильнику не враховуються, тож не затримують одне одного.
+    """
 
-        channel_filters = [f for f in filters if f[1] == channel_id]
-        should_forward = False
+    def __init__(self, interval=NOTIFY_DIGEST_INTERVAL, rate=NOTIFY_SEND_RATE, max_defer=NOTIFY_MAX_DEFER):
+        self.interval = interval
+        self.max_defer = max_defer
+        self._bucket = TokenBucket(rate, max(1, rate))
+        self._last_sent = {}
+        self._pending = OrderedDict()
+        self._tasks = set()
+
+    def notify(self, text, key=None):
+        key = key or text
+        now = time.monotonic()
+        last = self._last_sent.get(key)
+        if last is None or now - last >= self.interval:
+            self._last_sent[key] = now
+            self._spawn(self.broadcast(text))
+        else:
+            entry = self._pending.setdefault(key, [text, 0])
+            entry[0] = text
+            entry[1] += 1
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Надсилає дайджест повторних подій, накопичених з останнього скидання."""
+        pending, self._pending = self._pending, OrderedDict()
+        now = time.monotonic()
+        self._last_sent = {key: ts for key, ts in self._last_sent.items() if now - ts < self.interval * 2}
+        if not pending:
+            return
+        for key in pending:
+            self._last_sent[key] = now
+        minutes = max(1, round(self.interval / 60))
+        lines = [f"• {text} — ще {count} раз(ів)" for text, count in pending.values()]
+        header = f"Зведення сповіщень за останні {minutes} хв:"
+        for chunk in split_text(lines, header=header):
+            await self.broadcast(chunk)
+
+    async def broadcast(self, text):
+        admins = list(get_admins())
+        await asyncio.gather(*(self._send(int(admin_id), text) for admin_id in admins))
+
+    async def _send(self, admin_id, text):
+        deadline = time.monotonic() + self.max_defer
+        while outbox.forwarding and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        await self._bucket.acquire()
+        try:
+            await fanout.send(admin_id, lambda: bot.send_message(chat_id=admin_id, text=text))
+        except Exception as e:
+            logger.error(f"Failed to notify admin {admin_id}: {e}")
 
-        for filter_id, _, filter_type, filter_value in channel_filters:
-            if filter_type == 'tag':
-                if filter_value.lower() in text.lower():
-                    should_forward = True
-                    break
-            elif filter_type == 'word':
-                if re.search(r'\b' + re.escape(filter_value.lower()) + r'\b', text.lower()):
-                    should_forward = True
-                    break
-            elif filter_type == 'phrase':
-                if filter_value.lower() in text.lower():
-                    should_forward = True
-                    break
-            elif filter_type == 'combination':
-                elements = filter_value.split('&')
-                if all(element.strip().lower() in text.lower() for element in elements):
-                    should_forward = True
-                    break
+    async def close(self):
+        await self.flush()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+def split_text(lines, header="", limit=MAX_MESSAGE_LENGTH):
+    """Розбиває рядки на повідомлення, що вміщуються в ліміт Telegram."""
+    chunks = []
+    current = header
+    for line in lines:
+        line = line[:limit - len(header) - 1]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = header
+        current = f"{current}\n{line}" if current else line
+    if current and current != header:
+        chunks.append(current)
+    return chunks
+
+notifier = AdminNotifier()
+
+def notify_admins(message: str, key=None):
+    """Ставить сповіщення для всіх адміністраторів у чергу (повтори групуються за key)."""
+    notifier.notify(message, key)
+
+# Кластер
+# Кілька процесів працюють зі спільною БД у режимі WAL. Лідер, обраний через
+# оренду в таблиці leases, приймає оновлення від Telegram і виконує завдання
+# планувальника; outbox доставляють усі процеси, кожен свій шард каналів
+LEASE_TTL = float(os.getenv("LEASE_TTL", 15))
+CONFIG_POLL_INTERVAL = float(os.getenv("CONFIG_POLL_INTERVAL", 2))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def _acquire_lease(conn, name, owner, ttl, now):
+    """Захоплює або продовжує оренду; повертає True, якщо вона належить owner."""
+    conn.execute("INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                 "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                 "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                 (name, owner, now + ttl, now))
+    return conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()[0] == owner
+
+def _release_lease(conn, name, owner):
+    conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+class Leadership:
+    """Лідерство в кластері на основі оренди в БД.
+
+    Оренда продовжується кожні ttl/3 секунд. Якщо продовжити не вдалося,
+    процес одразу перестає бути лідером, а інший процес захопить оренду,
+    щойно вона спливе. В одиночному режимі процес завжди лідер.
+    """
 
-        if should_forward:
+    def __init__(self, database, name="leader", owner=WORKER_ID, ttl=LEASE_TTL, enabled=SHARD_COUNT > 1):
+        self.db = database
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.enabled = enabled
+        self.is_leader = not enabled
+        self.elected = asyncio.Event()
+        self.deposed = asyncio.Event()
+        (self.elected if self.is_leader else self.deposed).set()
+        self._task = None
+
+    def _set(self, leader):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        if leader:
+            self.deposed.clear()
+            self.elected.set()
+            logger.info(f"Worker {self.owner} became the cluster leader")
+        else:
+            self.elected.clear()
+            self.deposed.set()
+            logger.warning(f"Worker {self.owner} lost the cluster leadership")
+
+    async def _run(self):
+        while True:
             try:
-                await message.forward(chat_id=channel_id)
-                logger.info(f"Message forwarded to channel {channel_id}")
-                log_action("forward_message")
+                leader = await self.db.run(_acquire_lease, self.name, self.owner, self.ttl, time.time())
             except Exception as e:
-                logger.error(f"Error forwarding message to channel {channel_id}: {e}")
-                await notify_admins(f"Помилка при пересиланні повідомлення до каналу {channel_id}: {e}")
+                logger.error(f"Lease {self.name!r} renewal failed: {e}")
+                leader = False
+            self._set(leader)
+            await asyncio.sleep(self.ttl / 3)
 
-async def notify_admins(message: str):
-    """Надсилає сповіщення всім адміністраторам."""
-    admins = get_admins()
-    for admin_id in admins:
+    def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self.is_leader:
+            # Звільняємо оренду, щоб інший процес не чекав, поки вона спливе
+            await self.db.run(_release_lease, self.name, self.owner)
+            self.is_leader = False
+            logger.info(f"Worker {self.owner} released the cluster leadership")
+
+leadership = Leadership(db)
+
+metrics.gauge('cluster_leader', lambda: int(leadership.is_leader))
+
+def leader_only(func):
+    """Завдання планувальника, яке в кластері виконує лише лідер."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not leadership.is_leader:
+            return
+        return await func(*args, **kwargs)
+    return wrapper
+
+async def watch_config(interval=CONFIG_POLL_INTERVAL):
+    """Перечитує конфігурацію, коли її змінив інший процес кластера."""
+    while True:
+        await asyncio.sleep(interval)
         try:
-            await bot.send_message(chat_id=admin_id, text=message)
+            rows = await execute_db(CONFIG_VERSION_QUERY)
+            if rows[0][0] != get_config().db_version:
+                previous = get_channels()
+                await reload_config()
+                reschedule_expiries(previous)
         except Exception as e:
-            logger.error(f"Failed to notify admin {admin_id}: {e}")
+            logger.error(f"Config refresh failed: {e}")
 
+# Закінчення терміну дії каналів
+def _expiry_job_id(channel_id):
+    return f"expire_{channel_id}"
+
+def schedule_channel_expiry(channel_id, expiry_date):
+    """Планує видалення каналу рівно на момент закінчення терміну дії."""
+    scheduler.add_job(expire_channel, 'date', run_date=datetime.fromisoformat(expiry_date),
+                      args=[channel_id], id=_expiry_job_id(channel_id),
+                      replace_existing=True, misfire_grace_time=None)
+
+def unschedule_channel_expiry(channel_id):
+    try:
+        scheduler.remove_job(_expiry_job_id(channel_id))
+    except JobLookupError:
+        pass
+
+def schedule_all_expiries():
+    for channel_id, info in get_channels().items():
+        schedule_channel_expiry(channel_id, info['expiry_date'])
+
+def reschedule_expiries(previous):
+    """Узгоджує заплановані видалення з каналами, зміненими іншим процесом."""
+    channels = get_channels()
+    for channel_id in previous.keys() - channels.keys():
+        unschedule_channel_expiry(channel_id)
+    for channel_id, info in channels.items():
+        if previous.get(channel_id) != info:
+            schedule_channel_expiry(channel_id, info['expiry_date'])
+
+@leader_only
+async def expire_channel(channel_id):
+    """Видаляє канал, якщо його термін дії справді минув."""
+    info = get_channels().get(channel_id)
+    if info is None or datetime.fromisoformat(info['expiry_date']) > datetime.now():
+        return
+    await remove_channel(channel_id)
+    notify_admins(f"Канал {channel_id} видалено через закінчення терміну дії.")
+
+@leader_only
 async def check_expired_channels():
-    """Перевіряє та видаляє прострочені канали."""
+    """Видаляє канали, термін дії яких уже минув (запит використовує індекс по expiry_date)."""
     logger.info(f"start check_expired_channels")
-    channels = get_channels()
-    current_time = datetime.now()
-    for channel_id, info in list(channels.items()):
-        if datetime.fromisoformat(info['expiry_date']) < current_time:
-            remove_channel(channel_id)
-            await notify_admins(f"Канал {channel_id} видалено через закінчення терміну дії.")
+    overdue = await execute_db(OVERDUE_CHANNELS_QUERY, (datetime.now().isoformat(),))
+    for (channel_id,) in overdue:
+        await remove_channel(channel_id)
+        notify_admins(f"Канал {channel_id} видалено через закінчення терміну дії.")
+
+
+# Режим вебхука
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", 1))
+
+class WebhookIngest:
+    """Приймає оновлення через HTTP і передає їх диспетчеру пулом воркерів.
+
+    Черга обмежена: якщо вона заповнена довше за WEBHOOK_ENQUEUE_TIMEOUT,
+    відповідаємо 503, і Telegram повторить доставку пізніше.
+    """
 
+    def __init__(self, dispatcher, bot, secret=WEBHOOK_SECRET, queue_size=WEBHOOK_QUEUE_SIZE,
+                 workers=WEBHOOK_WORKERS, enqueue_timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret = secret
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.enqueue_timeout = enqueue_timeout
+        self._tasks = []
+
+    async def handle(self, request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Порівняння за сталий час, щоб секрет не можна було підібрати за часом відповіді
+        if self.secret and not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            await asyncio.wait_for(self.queue.put(update), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook queue is full ({self.queue.qsize()}), rejecting update {update.update_id}")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _work(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Дочікуємося вже прийнятих оновлень, потім зупиняємо воркерів
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def setup(self, app, path=WEBHOOK_PATH):
+        app.router.add_post(path, self.handle)
+
+async def run_webhook():
+    """Запускає вбудований aiohttp-сервер і реєструє вебхук у Telegram."""
+    ingest = WebhookIngest(dp, bot)
+    app = web.Application()
+    ingest.setup(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    ingest.start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                              secret_token=WEBHOOK_SECRET or None,
+                              allowed_updates=dp.resolve_used_update_types())
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await site.stop()
+        await ingest.stop()
+        await runner.cleanup()
 
 # Планування задач
 scheduler.add_job(check_expired_channels, 'interval', hours=1)
+scheduler.add_job(flush_analytics, 'interval', seconds=ANALYTICS_FLUSH_INTERVAL)
+scheduler.add_job(leader_only(rollup_analytics), 'interval', hours=1)
+scheduler.add_job(notifier.flush, 'interval', seconds=NOTIFY_DIGEST_INTERVAL)
+
+
+async def run_ingest():
+    """Приймає оновлення від Telegram через вебхук або long polling."""
+    if BOT_MODE == "webhook":
+        await run_webhook()
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot, handle_signals=False, close_bot_session=False)
 
+async def stop_ingest(task):
+    if BOT_MODE == "webhook":
+        task.cancel()
+    else:
+        try:
+            await dp.stop_polling()
+        except RuntimeError:
+            # Polling ще не встиг запуститися
+            task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+async def serve(stop):
+    """Приймає оновлення, поки процес є лідером кластера, до сигналу зупинки."""
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        while not stop.is_set():
+            elected = asyncio.create_task(leadership.elected.wait())
+            await asyncio.wait({stopping, elected}, return_when=asyncio.FIRST_COMPLETED)
+            elected.cancel()
+            if stop.is_set():
+                break
+            if leadership.enabled:
+                # Видаляємо канали, що прострочилися, поки лідера не було
+                await check_expired_channels()
+            ingest = asyncio.create_task(run_ingest())
+            deposed = asyncio.create_task(leadership.deposed.wait())
+            await asyncio.wait({stopping, deposed, ingest}, return_when=asyncio.FIRST_COMPLETED)
+            deposed.cancel()
+            if ingest.done():
+                ingest.result()
+                break
+            await stop_ingest(ingest)
+    finally:
+        stopping.cancel()
 
 async def main():
+    # Підготовка бази даних і кешу конфігурації
+    await init_db()
+    await reload_config()
+    # Видаляємо канали, що прострочилися під час простою, і плануємо решту
+    # (у кластері це робить лідер після обрання)
+    await check_expired_channels()
+    schedule_all_expiries()
     # Запуск планувальника
     scheduler.start()
-    # Запуск бота
-    await dp.start_polling(bot)
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    await outbox.recover()
+    outbox.start()
+    leadership.start()
+    config_watcher = asyncio.create_task(watch_config()) if SHARD_COUNT > 1 else None
+    metrics_runner = await start_metrics_server()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            pass
+    if SHARD_COUNT > 1:
+        logger.info(f"Worker {WORKER_ID} started as shard {SHARD_INDEX} of {SHARD_COUNT}")
+    try:
+        # Запуск бота
+        await serve(stop)
+    finally:
+        await leadership.stop()
+        # Дочікуємося альбомів, які ще збираються
+        await asyncio.gather(*_album_tasks, return_exceptions=True)
+        await outbox.stop()
+        if config_watcher:
+            config_watcher.cancel()
+        lag_monitor.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        scheduler.shutdown(wait=False)
+        await notifier.close()
+        await flush_analytics()
+        await bot.session.close()
+        await db.close()
+
+def run_cluster(workers):
+    """Запускає workers процесів бота (шарди 0..workers-1) і перезапускає ті, що завершилися."""
+    base, ext = os.path.splitext(log_filename)
+
+    def spawn(index):
+        # Кожен процес пише й ротує власний файл логу
+        env = dict(os.environ, SHARD_COUNT=str(workers), SHARD_INDEX=str(index), LOG_FILE=f"{base}.{index}{ext}")
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    processes = {index: spawn(index) for index in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while processes:
+        for index, process in list(processes.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            if stopping:
+                del processes[index]
+            else:
+                logger.warning(f"Worker for shard {index} exited with code {code}, restarting")
+                processes[index] = spawn(index)
+        time.sleep(1)
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="кількість процесів бота (кластерний режим)")
+    args = parser.parse_args()
+    if args.workers > 1:
+        run_cluster(args.workers)
+    else:
+        asyncio.run(main())
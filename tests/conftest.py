@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# bot.py читає налаштування та відкриває файл логу під час імпорту
+_TMP = tempfile.mkdtemp(prefix="bot_tests_")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("SUPERADMIN_ID", "1")
+os.environ.setdefault("DB_FILE", os.path.join(_TMP, "bot_data.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(_TMP, "bot.log"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
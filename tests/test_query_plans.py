@@ -0,0 +1,23 @@
+"""Запити гарячого шляху не повинні скочуватися до повного сканування таблиць."""
+import sqlite3
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(tmp_path / "bot_data.db")
+    bot._migrate(conn)
+    yield conn
+    conn.close()
+
+
+def test_hot_queries_use_indexes(conn):
+    assert bot.check_query_plans(conn) == []
+
+
+def test_full_scan_is_reported(conn):
+    query = "SELECT * FROM filters WHERE filter_value = ?"
+    assert bot.check_query_plans(conn, [(query, ('',))]) == [(query, "SCAN filters")]